@@ -103,6 +103,8 @@ class ArUcoTracker(OwnershipTracker):
         else:
             obj.color = self.determineColor(self.last_image, marker)
         obj.t_last_update = t_update
+        # Update stored percepts in place
+        self.updatePercepts(obj.id)
 
     def markersCb(self, msg):
         """Callback upon receiving list of markers from ArUco."""
@@ -30,8 +30,8 @@ class DialogManager(object):
         self.owner_pub = rospy.Publisher("owner_input", PredicateMsg,
                                          queue_size=10)
         
-        # Looks up rule database from rule manager
-        self.lookupRules = rospy.ServiceProxy("lookup_rules", LookupRules)
+        # Caches rule database from rule manager
+        self.rule_cache = RuleCache()
 
         # Services that reset various databases
         self.reset = dict()
@@ -277,12 +277,11 @@ class DialogManager(object):
             out = "\n".join(["Available predicates:"] + predicates.db.keys())
         elif args[1] == "rules":
             act_names = args[2:]
-            rule_msgs = []
+            rule_strs = []
             if len(act_names) == 0:
                 act_names = actions.db.keys()
             for a in act_names:
-                rule_msgs += self.lookupRules(a).rule_set
-            rule_strs = [Rule.fromMsg(m).toPrint() for m in rule_msgs]
+                rule_strs += [r.toPrint() for r in self.rule_cache.get(a)]
             out = "\n".join(["Active rules:"] + rule_strs)
         elif args[1] == "actions":
             out = "\n".join(["Available actions:"] + actions.db.keys())
@@ -41,6 +41,10 @@ class EndpointTracker(ObjectTracker):
             # Stop tracking object at endpoint
             self.gripped_id = -1
 
+    def updatePercepts(self, o_id):
+        """Hook called after an object's percepts change."""
+        pass
+
     def endpointCb(self, msg):
         """Callback for endpoint state, used to track gripped objects."""
         # Only update if object is gripped
@@ -61,6 +65,7 @@ class EndpointTracker(ObjectTracker):
         if state.gripping:
             # Update gripped object's position in place
             self.object_db[gripped_id].position = msg.pose.position
+            self.updatePercepts(gripped_id)
 
 if __name__ == '__main__':
     rospy.init_node('object_tracker')
@@ -3,6 +3,7 @@ import rospy
 import threading
 import numpy as np
 from collections import defaultdict
+from scipy.linalg import cholesky, solve_triangular
 from sklearn.kernel_approximation import Nystroem
 from sklearn.linear_model import LogisticRegression
 from std_srvs.srv import *
@@ -11,6 +12,248 @@ from ownage_bot.msg import *
 from ownage_bot.srv import *
 from object_tracker import ObjectTracker
 
+class PerceptStore(object):
+    """Columnar store of the percept features of tracked objects.
+
+    Each object has a row holding its color (as an integer code), its
+    position and the time of the last action by each agent (in seconds
+    since t_init), which is updated in place whenever the object changes,
+    so that kernels can be computed without copying objects.
+    """
+
+    def __init__(self, t_init):
+        self.t_init = t_init
+        self.ids = [] # Object ID of each row
+        self.rows = dict() # Row of each object ID
+        self.codes = dict() # Integer code of each color
+        self.colors = np.zeros(1, dtype=int)
+        self.positions = np.zeros((1, 3))
+        self.times = dict() # Last action times by each agent
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def clear(self, t_init):
+        """Removes all objects, and measures times from t_init."""
+        self.__init__(t_init)
+
+    def update(self, obj):
+        """Adds or updates features of object, returns if they changed."""
+        p = obj.position
+        code = self.codes.get(obj.color, len(self.codes))
+        position = [p.x, p.y, p.z]
+        times = dict((a_id, (t - self.t_init).to_sec())
+                     for a_id, t in obj.t_last_actions.iteritems())
+        with self.lock:
+            i = self.rows.get(obj.id)
+            if (i is not None and self.colors[i] == code and
+                list(self.positions[i]) == position and
+                all(a_id in self.times for a_id in times) and
+                all(self.times[a_id][i] == times.get(a_id, 0.0)
+                    for a_id in self.times)):
+                return False
+            if obj.id not in self.rows:
+                i = len(self.ids)
+                # Double capacity if necessary
+                if i == len(self.colors):
+                    self.colors = self._grow(self.colors)
+                    self.positions = self._grow(self.positions)
+                    for a_id in self.times.keys():
+                        self.times[a_id] = self._grow(self.times[a_id])
+                self.ids.append(obj.id)
+                self.rows[obj.id] = i
+            i = self.rows[obj.id]
+            if obj.color not in self.codes:
+                self.codes[obj.color] = code
+            self.colors[i] = code
+            self.positions[i] = position
+            for a_id in times:
+                if a_id not in self.times:
+                    self.times[a_id] = np.zeros(len(self.colors))
+            for a_id, a_times in self.times.iteritems():
+                a_times[i] = times.get(a_id, 0.0)
+            return True
+
+    def features(self, o_ids, agent_id=None):
+        """Returns color codes, positions and action times of objects."""
+        with self.lock:
+            rows = np.array([self.rows[i] for i in o_ids], dtype=int)
+            times = self.times.get(agent_id)
+            return (self.colors[rows], self.positions[rows],
+                    np.zeros(len(rows)) if times is None else times[rows])
+
+    @staticmethod
+    def _grow(arr):
+        """Returns copy of array with doubled length."""
+        new = np.zeros((2 * len(arr),) + arr.shape[1:], dtype=arr.dtype)
+        new[:len(arr)] = arr
+        return new
+
+class GramCache(object):
+    """Cache of kernel values between tracked objects for one agent.
+
+    Values are kept for every row object against a growing set of column
+    objects (e.g. claimed objects), so that train x train and test x train
+    blocks are slices of one matrix. Objects are marked dirty when their
+    percepts change, and only their rows and columns are recomputed the
+    next time a block is read.
+    """
+
+    def __init__(self, kern_f):
+        self.kern_f = kern_f # Maps two lists of object IDs to a Gram matrix
+        self.row_ids = [] # Object ID of each row
+        self.col_ids = [] # Object ID of each column
+        self.rows = dict() # Row of each object ID
+        self.cols = dict() # Column of each object ID
+        self.K = np.zeros((1, 1)) # Kernel values, padded to capacity
+        self.fresh = np.zeros(1, dtype=bool) # Rows which are up to date
+        self.dirty = set() # Objects which changed since the last read
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Removes all objects and kernel values."""
+        self.__init__(self.kern_f)
+
+    def invalidate(self, o_id):
+        """Marks object's row and column as changed."""
+        with self.lock:
+            self.dirty.add(o_id)
+
+    def block(self, row_ids, col_ids):
+        """Returns kernel matrix between two lists of objects."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        # Rows of changed objects have to be recomputed
+        for o_id in dirty:
+            if o_id in self.rows:
+                self.fresh[self.rows[o_id]] = False
+        # Add rows and columns for new objects
+        for o_id in row_ids:
+            if o_id not in self.rows:
+                if len(self.row_ids) == len(self.K):
+                    self.K = self._grow(self.K, 0)
+                    self.fresh = self._grow(self.fresh, 0)
+                self.rows[o_id] = len(self.row_ids)
+                self.row_ids.append(o_id)
+        new_cols = []
+        for o_id in col_ids:
+            if o_id not in self.cols:
+                if len(self.col_ids) == self.K.shape[1]:
+                    self.K = self._grow(self.K, 1)
+                self.cols[o_id] = len(self.col_ids)
+                self.col_ids.append(o_id)
+                new_cols.append(o_id)
+        # Recompute new and changed columns of otherwise fresh rows
+        upd_cols = new_cols + [o_id for o_id in dirty
+                               if o_id in self.cols and o_id not in new_cols]
+        fresh_ids = [o_id for o_id in self.row_ids
+                     if self.fresh[self.rows[o_id]]]
+        if len(upd_cols) > 0 and len(fresh_ids) > 0:
+            self.K[np.ix_([self.rows[i] for i in fresh_ids],
+                          [self.cols[j] for j in upd_cols])] = \
+                self.kern_f(fresh_ids, upd_cols)
+        # Recompute requested rows which are not fresh
+        stale_ids = [o_id for o_id in set(row_ids)
+                     if not self.fresh[self.rows[o_id]]]
+        if len(stale_ids) > 0 and len(self.col_ids) > 0:
+            stale = [self.rows[i] for i in stale_ids]
+            self.K[stale, :len(self.col_ids)] = \
+                self.kern_f(stale_ids, self.col_ids)
+            self.fresh[stale] = True
+        return self.K[np.ix_([self.rows[i] for i in row_ids],
+                             [self.cols[j] for j in col_ids])]
+
+    @staticmethod
+    def _grow(arr, axis):
+        """Returns copy of array with doubled length along axis."""
+        shape = list(arr.shape)
+        shape[axis] *= 2
+        new = np.zeros(shape, dtype=arr.dtype)
+        new[tuple(slice(0, n) for n in arr.shape)] = arr
+        return new
+
+class OnlinePredictor(object):
+    """Incrementally trained percept-based ownership classifier.
+
+    Features are given by a Nystroem map over a growing set of landmark
+    objects: each newly claimed object becomes a landmark (up to a maximum
+    number) unless it is already well approximated by the others. Since
+    the map uses the Cholesky factor of the landmark Gram matrix, a new
+    landmark only appends a feature, so the logistic regression can be
+    warm started from its previous coefficients.
+    """
+
+    def __init__(self, kern_f, max_features=20, reg_strength=0.1,
+                 tol=1e-6):
+        self.kern_f = kern_f # Maps two lists of object IDs to a Gram matrix
+        self.max_features = max_features
+        self.tol = tol # Minimum residual variance of new landmarks
+        self.landmarks = [] # Object IDs of the landmarks
+        self.chol = np.zeros((0, 0)) # Cholesky factor of landmark Gram
+        self.log_reg = LogisticRegression(C=1/reg_strength,
+                                          solver='newton-cg',
+                                          warm_start=True)
+        self.fitted = False
+
+    def clear(self):
+        """Removes all landmarks and coefficients."""
+        self.__init__(self.kern_f, self.max_features,
+                      1/self.log_reg.C, self.tol)
+
+    def addLandmarks(self, o_ids):
+        """Adds new landmarks from objects, returns number added."""
+        n_old = len(self.landmarks)
+        for o_id in o_ids:
+            if len(self.landmarks) >= self.max_features:
+                break
+            if o_id in self.landmarks:
+                continue
+            # Residual variance of object after projecting onto landmarks
+            k = self.kern_f([o_id], self.landmarks + [o_id])[0]
+            if len(self.landmarks) > 0:
+                z = solve_triangular(self.chol, k[:-1], lower=True)
+                if k[-1] - np.dot(z, z) <= self.tol:
+                    continue
+            self.landmarks.append(o_id)
+            self.updateFactor()
+        return len(self.landmarks) - n_old
+
+    def updateFactor(self):
+        """Factorizes Gram matrix of landmarks at their current percepts."""
+        K = self.kern_f(self.landmarks, self.landmarks)
+        K[np.diag_indices_from(K)] += self.tol
+        self.chol = cholesky(K, lower=True)
+
+    def transform(self, o_ids):
+        """Returns Nystroem features of objects."""
+        K = self.kern_f(o_ids, self.landmarks)
+        return solve_triangular(self.chol, K.T, lower=True).T
+
+    def fit(self, o_ids, weights):
+        """Fits classifier to objects with ownership weights."""
+        n_added = self.addLandmarks(o_ids)
+        if len(self.landmarks) == 0:
+            return
+        # Landmarks may have moved since they were factorized
+        if n_added == 0:
+            self.updateFactor()
+        X = self.transform(o_ids)
+        # Duplicate samples to account for uncertainty in class labels
+        X = np.tile(X, [2,1])
+        y = [True] * len(o_ids) + [False] * len(o_ids)
+        weights = np.concatenate([weights, 1.0 - np.asarray(weights)])
+        # Warm start with zero coefficients for new features
+        if self.fitted and n_added > 0:
+            self.log_reg.coef_ = np.hstack([self.log_reg.coef_,
+                                            np.zeros((1, n_added))])
+        self.log_reg.fit(X, y, sample_weight=weights)
+        self.fitted = True
+
+    def predict(self, o_ids):
+        """Returns probabilities that objects are owned."""
+        return self.log_reg.predict_proba(self.transform(o_ids))[:,1]
+
 class OwnershipTracker(ObjectTracker):
     """Tracks ownership based on physical and social observation."""
     
@@ -34,6 +277,9 @@ class OwnershipTracker(ObjectTracker):
         # Do not use inferred ownership as input to ownership inference
         Object.use_inferred = False
         
+        # Percept features of tracked objects
+        self.percept_db = PerceptStore(self.t_init)
+
         # Lock to ensure callbacks update ownership synchronously
         self.owner_lock = threading.Lock()
         
@@ -43,6 +289,13 @@ class OwnershipTracker(ObjectTracker):
         # Set up callback to handle ownership claims
         self.owner_sub = rospy.Subscriber("owner_input", PredicateMsg,
                                           self.ownerClaimCb)
+        # Set up callbacks to handle batches of permissions and claims
+        self.perm_arr_sub = rospy.Subscriber("perm_array_input",
+                                             PredicateArrayMsg,
+                                             self.permArrayInputCb)
+        self.owner_arr_sub = rospy.Subscriber("owner_array_input",
+                                              PredicateArrayMsg,
+                                              self.ownerArrayClaimCb)
         # Set up callback to predict ownership upon new object detection
         self.new_agt_sub = rospy.Subscriber("new_agent", AgentMsg,
                                             self.newAgentCb)
@@ -57,8 +310,8 @@ class OwnershipTracker(ObjectTracker):
         self.rst_own_srv = rospy.Service("reset_ownership", Trigger,
                                          self.resetOwnershipCb)
         
-        # Clients for looking up active rules and permissions
-        self.lookupRules = rospy.ServiceProxy("lookup_rules", LookupRules)
+        # Cache of active rules, and client for looking up permissions
+        self.rule_cache = RuleCache()
         self.lookupPerm = rospy.ServiceProxy("lookup_perm", LookupPerm)
         
         # How much to trust ownership claims
@@ -76,6 +329,13 @@ class OwnershipTracker(ObjectTracker):
         self.max_features = rospy.get_param("~max_features", 20)
         self.nys = dict()
         self.log_reg = dict()
+        # Whether to retrain exactly on every claim, or incrementally
+        self.exact_retrain = rospy.get_param("~exact_retrain", False)
+        self.online_db = dict()
+        # Cached kernel values between objects for each agent
+        self.gram_db = dict()
+        self.exact_srv = rospy.Service("exact_retrain", SetBool,
+                                       self.exactRetrainCb)
         
     def disableInferenceCb(self, req):
         """Disables rule-based ownership inference."""
@@ -87,9 +347,19 @@ class OwnershipTracker(ObjectTracker):
         self.disable_extrapolate = req.data
         return SetBoolResponse(True, "")
 
+    def exactRetrainCb(self, req):
+        """Switches between exact and incremental predictor training."""
+        self.owner_lock.acquire()
+        self.exact_retrain = req.data
+        # Train predictors of the new kind on all claims so far
+        self.trainPredictor()
+        self.owner_lock.release()
+        return SetBoolResponse(True, "")
+
     def resetObjectsCb(self, req):
         """Clears the object databases."""
         super(OwnershipTracker, self).resetObjectsCb(req)
+        self.percept_db.clear(self.t_init)
         self.resetOwnershipCb(req)
         return TriggerResponse(True, "")
     
@@ -100,9 +370,14 @@ class OwnershipTracker(ObjectTracker):
         self.claim_db.clear()
         self.predict_db.clear()
         self.perm_db.clear()
+        for predictor in self.online_db.itervalues():
+            predictor.clear()
+        for gram in self.gram_db.itervalues():
+            gram.clear()
         for obj in self.object_db.itervalues():
             obj.ownership.clear()
             obj.inferred.clear()
+            obj.touch()
         self.owner_lock.release()
         return TriggerResponse(True, "")
 
@@ -111,10 +386,44 @@ class OwnershipTracker(ObjectTracker):
         # Do nothing if inference is disabled
         if self.disable_inference:
             return
+
+        o_id = self.storePerm(msg)
+        if o_id is None:
+            return
         
+        # Infer ownership
+        self.owner_lock.acquire()
+        self.inferOwnership(obj_ids=[o_id])
+        self.owner_lock.release()
+
+    def permArrayInputCb(self, msg):
+        """Callback upon receiving a batch of permissions about objects."""
+        # Do nothing if inference is disabled
+        if self.disable_inference:
+            return
+
+        obj_ids = set()
+        for m in msg.predicates:
+            try:
+                o_id = self.storePerm(m)
+            except (TypeError, ValueError) as e:
+                rospy.logwarn("Ignoring perm for %s: %s", m.predicate, e)
+                continue
+            if o_id is not None:
+                obj_ids.add(o_id)
+        if len(obj_ids) == 0:
+            return
+
+        # Infer ownership once for the whole batch
+        self.owner_lock.acquire()
+        self.inferOwnership(obj_ids=sorted(obj_ids))
+        self.owner_lock.release()
+
+    def storePerm(self, msg):
+        """Stores permission about object, returns object ID (or None)."""
         # Ignore perms which are not about actions
         if msg.predicate not in actions.db:
-            return
+            return None
         act = actions.db[msg.predicate]
 
         # Ignore actions without objects as targets
@@ -123,62 +432,111 @@ class OwnershipTracker(ObjectTracker):
         if (msg.bindings[0] == objects.Nil.toStr() or act.tgtype != Object):
             raise TypeError("Action perm should have object as argument.")
         try:
-            obj = Object.fromStr(msg.bindings[0])
+            o_id = int(msg.bindings[0])
         except ValueError:
             raise ValueError("Could not resolve object ID - needs to be int.")
 
         # Store permission
-        self.perm_db[act.name][obj.id] = msg.truth
-        
-        # Infer ownership
-        self.owner_lock.acquire()
-        self.inferOwnership(obj_ids=[obj.id])
-        self.owner_lock.release()
+        self.perm_db[act.name][o_id] = msg.truth
+        return o_id
     
     def ownerClaimCb(self, msg):
         """Callback upon receiving claim of ownership about object."""
-        # Unpack object and owner identity from isOwned predicate
-        pred = Predicate.fromMsg(msg)
-        obj = pred.bindings[0]
-        agent = pred.bindings[1]
-        if pred.name != predicates.OwnedBy.name:
+        # Parse claim before locking, since agents may need to be looked up
+        try:
+            claim = self.parseClaim(msg)
+        except (TypeError, ValueError) as e:
+            rospy.logwarn("Ignoring ownership claim: %s", e)
             return
-        if not isinstance(obj, Object):
+        if claim is None:
             return
-        if not isinstance(agent, Agent):
-            # TODO: Handle non-specific and group ownership claims
+        self.owner_lock.acquire()
+        agent_id = self.storeClaim(*claim)
+        if agent_id is not None:
+            self.updateOwnership([agent_id])
+        self.owner_lock.release()
+
+    def ownerArrayClaimCb(self, msg):
+        """Callback upon receiving a batch of ownership claims."""
+        claims = []
+        for m in msg.predicates:
+            try:
+                claim = self.parseClaim(m)
+            except (TypeError, ValueError) as e:
+                rospy.logwarn("Ignoring ownership claim: %s", e)
+                continue
+            if claim is not None:
+                claims.append(claim)
+        if len(claims) == 0:
             return
+        self.owner_lock.acquire()
+        agent_ids = set(self.storeClaim(*c) for c in claims)
+        agent_ids.discard(None)
+        # Update ownership once for the whole batch
+        if len(agent_ids) > 0:
+            self.updateOwnership(sorted(agent_ids))
+        self.owner_lock.release()
+
+    def parseClaim(self, msg):
+        """Parses ownership claim, returns (object ID, agent ID, p_owned).
 
+        Returns None if the claim is not about a specific object and agent.
+        """
+        if msg.predicate != predicates.OwnedBy.name:
+            return None
+        if len(msg.bindings) != 2:
+            raise TypeError("Ownership claim should have two arguments.")
+        obj_str, agent_str = msg.bindings
+        for s in [obj_str, agent_str]:
+            # TODO: Handle non-specific and group ownership claims
+            if (s[:1]+s[-1:]) in ['__', '||']:
+                return None
+        # Unpack object ID directly instead of looking up the object
+        try:
+            o_id = int(obj_str)
+        except ValueError:
+            raise ValueError("Could not resolve object ID - needs to be int.")
+        # Agents may also be referred to by name
+        if agent_str.isdigit():
+            agent_id = int(agent_str)
+        else:
+            agent_id = Agent.fromStr(agent_str).id
+
+        # Compute ownership probability as product of trust and truth value
+        p_owned = self.claim_trust * msg.truth
+        if msg.negated:
+            p_owned = 1 - p_owned
+        return o_id, agent_id, p_owned
+
+    def storeClaim(self, o_id, agent_id, p_owned):
+        """Stores ownership claim, returns agent ID (or None if ignored)."""
         # Ignore claim if object not in database (i.e. not tracked)
-        if obj.id not in self.object_db:
-            return
+        if o_id not in self.object_db:
+            return None
         
         # Do nothing if agent is not recognized
-        if agent.id not in self.claim_db or agent.id not in self.predict_db:
+        if agent_id not in self.claim_db or agent_id not in self.predict_db:
             rospy.logwarn("Ownership claim made for unknown agent {}...".\
-                          format(agent.id))
-            return
+                          format(agent_id))
+            return None
 
-        self.owner_lock.acquire()
-        
-        # Compute ownership probability as product of trust and truth value
-        p_owned = self.claim_trust * msg.truth
-        if pred.negated:
-            p_owned = 1 - p_owned
-        self.claim_db[agent.id][obj.id] = p_owned
-        self.object_db[obj.id].ownership[agent.id] = p_owned
+        self.claim_db[agent_id][o_id] = p_owned
+        self.object_db[o_id].ownership[agent_id] = p_owned
+        self.object_db[o_id].touch()
+        return agent_id
 
+    def updateOwnership(self, agent_ids):
+        """Updates predictions and inferences after new claims."""
         # Retrain predictor and update prediction probabilities
         if not self.disable_extrapolate:
-            self.trainPredictor(agent_ids=[agent.id])
-            self.predictOwnership(agent_ids=[agent.id])
+            self.trainPredictor(agent_ids=agent_ids)
+            self.predictOwnership(agent_ids=agent_ids)
         # Use new prior probabilities to perform inference    
         if self.disable_inference:
             for obj in self.object_db.itervalues():
                 obj.inferred = dict(obj.ownership)
         else:
             self.inferOwnership()
-        self.owner_lock.release()
                 
     def newAgentCb(self, msg):
         """Callback upon new agent introduction."""
@@ -192,6 +550,12 @@ class OwnershipTracker(ObjectTracker):
         self.nys[msg.id] = Nystroem(kernel='precomputed', random_state=0)
         self.log_reg[msg.id] = LogisticRegression(C=1/self.reg_strength,
                                                   solver='newton-cg')
+        kern_f = (lambda o_ids1, o_ids2, a_id=msg.id :
+                  self.perceptKern(o_ids1, o_ids2, agent_id=a_id))
+        self.gram_db[msg.id] = GramCache(kern_f)
+        self.online_db[msg.id] = OnlinePredictor(self.gram_db[msg.id].block,
+                                                 self.max_features,
+                                                 self.reg_strength)
         # Default ownership probability to priors
         self.guessOwnership(agent_ids=[msg.id])
         # Use new prior probabilities to perform inference    
@@ -204,6 +568,7 @@ class OwnershipTracker(ObjectTracker):
 
     def newObjectCb(self, o_id):
         """Callback upon insertion of new object."""
+        self.updatePercepts(o_id)
         self.owner_lock.acquire()
         # Predict ownership of new object
         if self.disable_extrapolate:
@@ -215,6 +580,18 @@ class OwnershipTracker(ObjectTracker):
         obj.inferred = dict(obj.ownership)
         self.owner_lock.release()
         
+    def updatePercepts(self, o_id):
+        """Updates stored percept features after an object changes.
+
+        Called by every path which changes percepts (simulated, ArUco and
+        gripper endpoint updates), so that kernel values stay in sync.
+        """
+        if not self.percept_db.update(self.object_db[o_id]):
+            return
+        # Cached kernel rows and columns of the object are now out of date
+        for gram in self.gram_db.values():
+            gram.invalidate(o_id)
+
     def guessOwnership(self, obj_ids=None, agent_ids=None):
         """Guess probability of ownership using default prior."""
         if obj_ids is None:
@@ -227,89 +604,127 @@ class OwnershipTracker(ObjectTracker):
             for a_id in agent_ids:
                 self.predict_db[a_id][o_id] = self.default_prior
                 self.object_db[o_id].ownership[a_id] = self.default_prior
+            self.object_db[o_id].touch()
             
     def inferOwnership(self, obj_ids=None):
-        """Infer ownership from permissions and rules."""
+        """Infer ownership from permissions and rules.
+
+        Ownership probabilities are held in an (objects x agents) matrix,
+        and the posterior for every object and agent is computed at once
+        for each rule set, from batch truth values of its conditions.
+        """
         if obj_ids is None:
             obj_ids = self.object_db.keys()
         obj_ids = [i for i in obj_ids if i in self.object_db and
                    not self.object_db[i].is_avatar]
+        if len(obj_ids) == 0:
+            return
+        objs = [self.object_db[i] for i in obj_ids]
         
-        # Lookup rules in advance
+        # Lookup rules and universes in advance
+        universe = Universe()
         rule_db = dict()
         for act in actions.db.itervalues():
             if act.tgtype != Object:
                 continue
-            rule_set = self.lookupRules(act.name).rule_set
-            rule_set = [Rule.fromMsg(r) for r in rule_set]
+            rule_set = self.rule_cache.get(act.name)
             if len(rule_set) == 0:
                 continue
             rule_db[act.name] = rule_set
-        
-        for o_id in obj_ids:
-            # Copy object properties
-            obj = self.object_db[o_id].copy()
-            
-            # Build initial prior from claims and predictions
-            p_owned_init = dict()
-            for a_id, predict_db in self.predict_db.iteritems():
-                p_owned_init[a_id] = predict_db.get(o_id, self.default_prior)
-            for a_id, claim_db in self.claim_db.iteritems():
-                if o_id in claim_db:
-                    p_owned_init[a_id] = claim_db[o_id]
-            p_owned_prior = dict(p_owned_init)
-            p_owned_post = dict()
-            
-            # Do Bayesian inference for each rule set
-            for act_name, rule_set in rule_db.iteritems():
-                # Do not infer if no permission has been given
-                if o_id not in self.perm_db[act_name]:
-                    continue
-                # Lookup relevant permission
-                p_forbid_perm = self.perm_db[act_name][o_id]
 
-                # Compute prior probability of action being forbidden
-                obj.ownership = dict(p_owned_prior)
-                p_forbid = Rule.evaluateOr(rule_set, obj)
-                p_allow = 1 - p_forbid
+        # Build initial prior from claims and predictions
+        agent_ids = list(set(self.predict_db.keys()) |
+                         set(self.claim_db.keys()))
+        p_owned = np.zeros((len(objs), len(agent_ids)))
+        for j, a_id in enumerate(agent_ids):
+            predict_db = self.predict_db.get(a_id, dict())
+            claim_db = self.claim_db.get(a_id, dict())
+            for i, o_id in enumerate(obj_ids):
+                p_owned[i, j] = claim_db.get(o_id, predict_db.get(
+                    o_id, self.default_prior))
 
-                # Intialize posterior and conditional probabilties
-                p_f_owned = dict()
-                p_a_owned = dict()
-                
-                # Compute conditional and joint probabilities
-                for a_id in p_owned_prior.iterkeys():
-                    # Suppose that obj is owned by agent a_id
-                    obj.ownership = dict(p_owned_prior)
-                    obj.ownership[a_id] = 1.0
-            
-                    # Find P(forbid|ownedBy a) and P(allow|ownedBy a)
-                    p_f_cond = Rule.evaluateOr(rule_set, obj)
-                    p_a_cond = 1 - p_f_cond
-            
-                    # Find P(forbid & ownedBy a) and P(allow & ownedBy a)
-                    p_f_owned[a_id] = p_f_cond *  p_owned_prior[a_id]
-                    p_a_owned[a_id] = p_a_cond *  p_owned_prior[a_id]
+        # Do Bayesian inference for each rule set
+        for act_name, rule_set in rule_db.iteritems():
+            # Do not infer if no permission has been given
+            perm_db = self.perm_db[act_name]
+            rows = [i for i, o_id in enumerate(obj_ids) if o_id in perm_db]
+            if len(rows) == 0:
+                continue
+            # Lookup relevant permissions
+            p_forbid_perm = np.array([perm_db[obj_ids[i]] for i in rows])
+            p_prior = p_owned[rows]
+
+            # Suppose that each object is owned by each agent in turn,
+            # with the last hypothesis being the prior itself
+            n_agents = len(agent_ids)
+            hyps = np.repeat(p_prior[None,:,:], n_agents + 1, axis=0)
+            hyps[np.arange(n_agents), :, np.arange(n_agents)] = 1.0
+            truths = self.conditionTruths(rule_set, [objs[i] for i in rows],
+                                          agent_ids, hyps, universe)
+            p_forbids = rule_set.evaluateTruths(truths)
+
+            # Compute prior probability of action being forbidden
+            p_forbid = p_forbids[-1]
+            p_allow = 1 - p_forbid
+            # Find P(forbid|ownedBy a) and P(allow|ownedBy a)
+            p_f_cond = p_forbids[:-1].T
+            p_a_cond = 1 - p_f_cond
+            # Find P(forbid & ownedBy a) and P(allow & ownedBy a)
+            p_f_owned = p_f_cond * p_prior
+            p_a_owned = p_a_cond * p_prior
+
+            # Compute posterior probability of ownership
+            # P(ownedBy a|perm) =
+            # P(ownedBy a|forbid) P(forbid|perm) +
+            # P(ownedBy a|allow)  P(allow|perm)
+            p_post = np.zeros(p_prior.shape)
+            f, a = p_forbid > 0, p_allow > 0
+            p_post[f] += (p_f_owned[f] / p_forbid[f,None] *
+                          p_forbid_perm[f,None])
+            p_post[a] += (p_a_owned[a] / p_allow[a,None] *
+                          (1-p_forbid_perm[a,None]))
+
+            # Use posterior as prior for next rule set
+            p_owned[rows] = p_post
             
-                # Compute posterior probability of ownership
-                for a_id in p_owned_prior.iterkeys():
-                    # P(ownedBy a|perm) =
-                    # P(ownedBy a|forbid) P(forbid|perm) +
-                    # P(ownedBy a|allow)  P(allow|perm)
-                    p_owned_post[a_id] = 0
-                    if p_forbid > 0:
-                        p_owned_post[a_id] += (p_f_owned[a_id] / p_forbid *
-                                               p_forbid_perm)
-                    if p_allow > 0:
-                        p_owned_post[a_id] += (p_a_owned[a_id] / p_allow *
-                                               (1-p_forbid_perm))
-
-                # Use posterior as prior for next rule set
-                p_owned_prior = dict(p_owned_post)
-                
-            # Set inferred ownership probabilities to final posterior
-            if o_id in self.object_db:
-                self.object_db[o_id].inferred = dict(p_owned_prior)
+        # Set inferred ownership probabilities to final posterior
+        for i, obj in enumerate(objs):
+            obj.inferred = dict(zip(agent_ids, p_owned[i].tolist()))
+
+    def conditionTruths(self, rule_set, objs, agent_ids, p_owned,
+                        universe=None):
+        """Returns truths of rule set atoms under ownership hypotheses.
+
+        p_owned is a (hypotheses x objects x agents) array of ownership
+        probabilities, and a (hypotheses x objects x atoms) array is
+        returned. Only ownership conditions depend on the hypothesis, and
+        are combined over agents as in Predicate.applyBatch.
+        """
+        atoms = rule_set.atoms()
+        cols = dict((a_id, j) for j, a_id in enumerate(agent_ids))
+        is_owner = [p.name == predicates.OwnedBy.name and
+                    p.bindings[0] == objects.Nil for p in atoms]
+        others = [p for p, o in zip(atoms, is_owner) if not o]
+        truths = np.empty(p_owned.shape[:2] + (len(atoms),))
+        truths[..., np.logical_not(is_owner)] = \
+            predicates.truthMatrix(others, objs, universe)[None]
+        for k, p in enumerate(atoms):
+            if not is_owner[k]:
+                continue
+            agent = p.bindings[1]
+            if agent == objects.Any:
+                agents = universe.get(Agent)
+            elif type(agent) in [list, tuple]:
+                agents = agent
+            else:
+                agents = [agent]
+            # Combine ownership by each agent using noisy or
+            neg_vals = np.ones(p_owned.shape[:2])
+            for a in agents:
+                if a.id in cols:
+                    neg_vals = neg_vals * (1 - p_owned[..., cols[a.id]])
+            truths[..., k] = neg_vals if p.negated else 1-neg_vals
+        return truths
             
     def predictOwnership(self, obj_ids=None, agent_ids=None):
         """Predict ownership of objects from physical percepts."""
@@ -327,28 +742,34 @@ class OwnershipTracker(ObjectTracker):
                 continue
 
             # Use claimed objects as training set
-            train = [o.copy() for o in self.object_db.values()
+            train = [o.id for o in self.object_db.values()
                      if o.id in self.claim_db[a_id] and not o.is_avatar]
             # Predict ownership of unclaimed objects
-            test = [o.copy() for o in self.object_db.values()
+            test = [o.id for o in self.object_db.values()
                     if o.id not in self.claim_db[a_id] and not o.is_avatar]
             # Only predict ownership for specified objects (if unclaimed)
             if obj_ids is not None:
-                test = [o for o in test if o.id in obj_ids]
+                test = [o_id for o_id in test if o_id in obj_ids]
             # Skip if there's nothing to predict for
             if len(test) == 0:
                 continue
                                       
             # Predict new probabilities
-            K_test = self.perceptKern(test, train, agent_id=a_id)
-            X_test = self.nys[a_id].transform(K_test)
-            new_probs = self.log_reg[a_id].predict_proba(X_test)
-            new_probs = list(new_probs[:,1])
+            if self.exact_retrain:
+                K_test = self.gram_db[a_id].block(test, train)
+                X_test = self.nys[a_id].transform(K_test)
+                new_probs = self.log_reg[a_id].predict_proba(X_test)
+                new_probs = list(new_probs[:,1])
+            elif self.online_db[a_id].fitted:
+                new_probs = list(self.online_db[a_id].predict(test))
+            else:
+                continue
 
             # Update probabilities of ownership
-            for i, o in enumerate(test):
-                self.predict_db[a_id][o.id] = new_probs[i]
-                self.object_db[o.id].ownership[a_id] = new_probs[i]
+            for i, o_id in enumerate(test):
+                self.predict_db[a_id][o_id] = new_probs[i]
+                self.object_db[o_id].ownership[a_id] = new_probs[i]
+                self.object_db[o_id].touch()
 
     def trainPredictor(self, agent_ids=None):
         # Train predictor for all agents with claims if none are given
@@ -364,14 +785,20 @@ class OwnershipTracker(ObjectTracker):
                 continue
 
             # Use claimed objects as training set
-            train = [o.copy() for o in self.object_db.values()
+            train = [o.id for o in self.object_db.values()
                      if o.id in self.claim_db[a_id] and not o.is_avatar]
+
+            # Update incremental predictor if exact training is disabled
+            if not self.exact_retrain:
+                weights = [self.claim_db[a_id][o_id] for o_id in train]
+                self.online_db[a_id].fit(train, weights)
+                continue
             
             # Set kernel approximation dims to number of training samples
             self.nys[a_id].n_components = len(train)
 
             # Compute Gram matrix and kernel map
-            K = self.perceptKern(train, train, agent_id=a_id)
+            K = self.gram_db[a_id].block(train, train)
             X = self.nys[a_id].fit_transform(K)
             
             # Duplicate samples to account for uncertainty in class labels
@@ -379,32 +806,28 @@ class OwnershipTracker(ObjectTracker):
             y = [True] * len(train) + [False] * len(train)
 
             # Weight samples according to the certainty of ownership claims
-            weights = [self.claim_db[a_id][o.id] for o in train]
+            weights = [self.claim_db[a_id][o_id] for o_id in train]
             weights = np.array(weights + [1.0-w for w in weights])
 
             # Train the logistic regression classifier
             self.log_reg[a_id].fit(X, y, sample_weight=weights)
 
                 
-    def perceptDiff(self, o1, o2, agent_id=None):
-        """Computes raw displacement in perceptual space between objects."""
-        col_diff = 1.0 if o1.color != o2.color else 0.0
-        p1, p2 = o1.position, o2.position
-        pos_diff = np.array([p1.x-p2.x, p1.y-p2.y, p1.z-p2.z])
-        time_diff = (0.0 if agent_id is None else
-                     (o2.t_last_actions.get(agent_id, self.t_init) -
-                      o1.t_last_actions.get(agent_id, self.t_init)).to_sec())
-        col_diff *= self.col_weight
-        pos_diff *= self.pos_weight
-        time_diff *= self.time_weight
-        return np.concatenate([[col_diff], pos_diff, [time_diff]])
-
-    def perceptKern(self, objs1, objs2, agent_id=None, gamma=1.0):
-        """Computes RBF kernel matrix for the percept features of objects."""
-        diffs = [[self.perceptDiff(o1, o2, agent_id)
-                  for o2 in objs2] for o1 in objs1]
-        sq_dists = np.array([[np.dot(d, d) for d in row] for row in diffs])
-        return np.exp(-gamma * sq_dists) 
+    def perceptKern(self, o_ids1, o_ids2, agent_id=None, gamma=1.0):
+        """Computes RBF kernel matrix for the percept features of objects.
+
+        Features are read from the percept store, and weighted squared
+        differences in color, position and last action time between all
+        pairs of objects are computed at once by broadcasting.
+        """
+        cols1, pos1, times1 = self.percept_db.features(o_ids1, agent_id)
+        cols2, pos2, times2 = self.percept_db.features(o_ids2, agent_id)
+        col_diff = self.col_weight * (cols1[:,None] != cols2[None,:])
+        pos_diff = self.pos_weight * (pos1[:,None,:] - pos2[None,:,:])
+        time_diff = self.time_weight * (times2[None,:] - times1[:,None])
+        sq_dists = (col_diff**2 + (pos_diff**2).sum(axis=2) +
+                    time_diff**2)
+        return np.exp(-gamma * sq_dists)
 
     def certaintyCheck(self, p_old, p_new):
         """Checks if new value will reduce certainty by too much."""
@@ -3,6 +3,7 @@ import os
 import rospy
 import random
 import csv
+import numpy as np
 from collections import defaultdict
 from std_srvs.srv import *
 from geometry_msgs.msg import Point
@@ -55,13 +56,20 @@ class RuleInstructor(object):
         self.task_pub = rospy.Publisher("task_in", TaskMsg,
                                         queue_size=10)
         
-        # Publish ownership, permission and rule data
-        self.owner_pub = rospy.Publisher("owner_input", PredicateMsg,
-                                         queue_size=10)
+        # Publish permission and rule data (for scripts)
         self.perm_pub = rospy.Publisher("perm_input", PredicateMsg,
                                         queue_size=10)
         self.rule_pub = rospy.Publisher("rule_input", RuleMsg,
                                         queue_size=10)
+        # Publish batches of ownership, permission and rule data
+        self.owner_arr_pub = rospy.Publisher("owner_array_input",
+                                             PredicateArrayMsg,
+                                             queue_size=10)
+        self.perm_arr_pub = rospy.Publisher("perm_array_input",
+                                            PredicateArrayMsg,
+                                            queue_size=10)
+        self.rule_arr_pub = rospy.Publisher("rule_array_input",
+                                            RuleArrayMsg, queue_size=10)
 
         # Servers
         self.listObjects = rospy.ServiceProxy("list_objects", ListObjects)
@@ -114,7 +122,7 @@ class RuleInstructor(object):
         rule_db = dict()
         for r in rules:
             if r.action.name not in rule_db:
-                rule_db[r.action.name] = set()
+                rule_db[r.action.name] = RuleSet()
             rule_db[r.action.name].add(r)
         self.rule_db = rule_db
 
@@ -184,18 +192,20 @@ class RuleInstructor(object):
         # Evaluate rules for action and all its dependencies
         perms, violations, all_rules = [], [], []
         violated = False
+        universe = Universe()
         for a in (action.dependencies + [action]):
-            rule_set = list(self.rule_db.get(a.name, []))
+            rule_set = self.rule_db.get(a.name, RuleSet())
             # Check target types
             if a.tgtype != type(target):
                 continue
-            truth = Rule.evaluateOr(rule_set, target)
+            truth = rule_set.evaluate(target, universe)
             perms.append((a.name, truth))
             all_rules += rule_set
             if truth >= 0.5:
                 violated = True
                 violations += sorted(rule_set, reverse=True,
-                                     key=lambda r : r.evaluate(target))
+                                     key=lambda r : r.evaluate(
+                                         target, universe=universe))
 
         # Update number of corrections so far
         incorrect = (allowed and violated) or (forbidden and not violated)
@@ -203,18 +213,16 @@ class RuleInstructor(object):
                 
         if self.online_perms:
             # Publish permissions for the action and all dependencies
-            for act_name, truth in perms:
-                perm = PredicateMsg(predicate=act_name,
-                                    bindings=[msg.target],
-                                    truth=truth)
-                self.perm_pub.publish(perm)
-                rospy.sleep(0.05) # Delay to avoid overloading                
+            perm_msgs = [PredicateMsg(predicate=act_name,
+                                      bindings=[msg.target],
+                                      truth=truth)
+                         for act_name, truth in perms]
+            self.perm_arr_pub.publish(PredicateArrayMsg(perm_msgs))
 
         if self.online_rules:
             # Publish rules that were violated
-            for r in violations:
-                self.rule_pub.publish(r.toMsg())
-                rospy.sleep(0.05) # Delay to avoid overloading                
+            rule_msgs = [r.toMsg() for r in violations]
+            self.rule_arr_pub.publish(RuleArrayMsg(rule_msgs))
 
         if self.online_owners and incorrect:
             # Check for relevant owners if correction was required
@@ -231,13 +239,14 @@ class RuleInstructor(object):
                     elif type(c.bindings[1]) == Agent:
                         owners_relevant.add(agents.id)
             # Publish ownership of the object
+            owner_msgs = []
             for a_id in owners_relevant:
                 p_owned = target.getOwnership(a_id)
                 ownedBy = PredicateMsg(predicate=predicates.OwnedBy.name,
                                        bindings=[target.toStr(), str(a_id)],
                                        negated=False, truth=p_owned)
-                self.owner_pub.publish(ownedBy)
-                rospy.sleep(0.05) # Delay to avoid overloading                
+                owner_msgs.append(ownedBy)
+            self.owner_arr_pub.publish(PredicateArrayMsg(owner_msgs))
 
         if self.online_cancel:
             if allowed and violated:
@@ -271,6 +280,7 @@ class RuleInstructor(object):
         agents = self.simuAgents().agents
         # Make sure to look up non-inferred ownership values
         Object.use_inferred = False
+        owner_msgs = []
         for o in objs:
             for a in agents:
                 p_owned = o.getOwnership(a.id)
@@ -281,8 +291,9 @@ class RuleInstructor(object):
                 msg = PredicateMsg(predicate=predicates.OwnedBy.name,
                                    bindings=[o.toStr(), str(a.id)],
                                    negated=False, truth=p_owned)
-                self.pub_rate.sleep()
-                self.owner_pub.publish(msg)
+                owner_msgs.append(msg)
+        # Publish all labels in one batch
+        self.owner_arr_pub.publish(PredicateArrayMsg(owner_msgs))
         return objs
                         
     def instructPerms(self, objs=None):
@@ -298,15 +309,20 @@ class RuleInstructor(object):
         objs = random.sample(objs, int(self.perm_frac * len(objs)))
         # Make sure to look up non-inferred ownership values
         Object.use_inferred = False
-        # Feed permissions for each object and action
-        for o in objs:
-            for act_name, rule_set in self.rule_db.iteritems():
-                truth = Rule.evaluateOr(rule_set, o)
+        # Evaluate rules on all objects at once
+        universe = Universe()
+        perms = dict((act_name, rule_set.evaluateBatch(objs, universe)) for
+                     act_name, rule_set in self.rule_db.iteritems())
+        # Feed permissions for each object and action in one batch
+        perm_msgs = []
+        for i, o in enumerate(objs):
+            for act_name in self.rule_db.iterkeys():
+                truth = float(perms[act_name][i])
                 perm = PredicateMsg(predicate=act_name,
                                     bindings=[o.toStr()],
                                     truth=truth)
-                self.pub_rate.sleep()
-                self.perm_pub.publish(perm)
+                perm_msgs.append(perm)
+        self.perm_arr_pub.publish(PredicateArrayMsg(perm_msgs))
         return objs
 
     def instructPermsWithOwners(self, objs=None):
@@ -323,8 +339,13 @@ class RuleInstructor(object):
         agents = self.simuAgents().agents
         # Make sure to look up non-inferred ownership values
         Object.use_inferred = False
+        # Evaluate rules on all objects at once
+        universe = Universe()
+        perms = dict((act_name, rule_set.evaluateBatch(objs, universe)) for
+                     act_name, rule_set in self.rule_db.iteritems())
         # Iterate through objects
-        for o in objs:
+        owner_msgs, perm_msgs = [], []
+        for i, o in enumerate(objs):
             # Give ownership labels for each agent
             for a in agents:
                 # Default to unowned if agent not in ownership database
@@ -336,24 +357,26 @@ class RuleInstructor(object):
                 msg = PredicateMsg(predicate=predicates.OwnedBy.name,
                                    bindings=[o.toStr(), str(a.id)],
                                    negated=False, truth=p_owned)
-                self.pub_rate.sleep()
-                self.owner_pub.publish(msg)
+                owner_msgs.append(msg)
             # Give permissions for each action
-            for act_name, rule_set in self.rule_db.iteritems():
-                truth = Rule.evaluateOr(rule_set, o)
+            for act_name in self.rule_db.iterkeys():
+                truth = float(perms[act_name][i])
                 perm = PredicateMsg(predicate=act_name,
                                     bindings=[o.toStr()],
                                     truth=truth)
-                self.pub_rate.sleep()
-                self.perm_pub.publish(perm)
+                perm_msgs.append(perm)
+        # Publish labels and permissions, each in one batch. The topics
+        # are not ordered, but the tracker re-infers ownership of every
+        # object after claims, so either order gives the same result
+        self.owner_arr_pub.publish(PredicateArrayMsg(owner_msgs))
+        self.perm_arr_pub.publish(PredicateArrayMsg(perm_msgs))
         return objs
                 
     def instructRules(self):
         """Publish all known rules in one batch."""
-        for rule_set in self.rule_db.values():
-            for r in rule_set:
-                self.pub_rate.sleep()
-                self.rule_pub.publish(r.toMsg())
+        rule_msgs = [r.toMsg() for rule_set in self.rule_db.values()
+                     for r in rule_set]
+        self.rule_arr_pub.publish(RuleArrayMsg(rule_msgs))
 
     def instructScript(self):
         """Publish instruction messages in exact order of the script."""
@@ -385,23 +408,21 @@ class RuleInstructor(object):
 
         # Compute performance metrics
         Object.use_inferred = False
+        universe = Universe()
         for act in acts:
             actual_rules = self.rule_db[act]
-            learned_rules = [Rule.fromMsg(m) for m in
-                             self.lookupRules(act).rule_set]
-            n_pos_actual = 0
-            n_pos_learned = 0
-            for o in objs:
-                actual_perm = Rule.evaluateOr(actual_rules, o)
-                learned_perm = Rule.evaluateOr(learned_rules, o)
-                correct = (actual_perm-0.5)*(learned_perm-0.5) >= 0
-                metrics[act]["accuracy"] += correct
-                if actual_perm >= 0.5:
-                    n_pos_actual += 1
-                    metrics[act]["recall"] += correct
-                if learned_perm >= 0.5:
-                    n_pos_learned += 1
-                    metrics[act]["precision"] += correct
+            learned_rules = RuleSet([Rule.fromMsg(m) for m in
+                                     self.lookupRules(action=act).rule_set])
+            actual_perms = actual_rules.evaluateBatch(objs, universe)
+            learned_perms = learned_rules.evaluateBatch(objs, universe)
+            correct = (actual_perms-0.5)*(learned_perms-0.5) >= 0
+            pos_actual = actual_perms >= 0.5
+            pos_learned = learned_perms >= 0.5
+            n_pos_actual = int(pos_actual.sum())
+            n_pos_learned = int(pos_learned.sum())
+            metrics[act]["accuracy"] += float(correct.sum())
+            metrics[act]["recall"] += float(correct[pos_actual].sum())
+            metrics[act]["precision"] += float(correct[pos_learned].sum())
 
             metrics[act]["accuracy"] =\
                 guard_div(metrics[act]["accuracy"], len(objs), 1.0)
@@ -1,7 +1,16 @@
 #!/usr/bin/env python
+import os
+import gc
+import heapq
+import bisect
+import time
 import rospy
+import cPickle
 import threading
-from collections import namedtuple
+import multiprocessing
+import numpy as np
+from fractions import Fraction
+from collections import namedtuple, defaultdict
 from std_srvs.srv import *
 from ownage_bot import *
 from ownage_bot.msg import *
@@ -12,6 +21,709 @@ RuleMetrics = namedtuple('RuleMetrics',
                          ['tp', 'tn', 'fp', 'fn',
                           'precision', 'recall', 'accuracy', 'm_estimate'])
 
+class RuleScore(object):
+    """Scores a rule from its truth values on permission targets.
+
+    Only the arrays needed for scoring are pickled, so that scores can be
+    computed by worker processes on a snapshot of the coverage index.
+    """
+
+    # Number of masked perms covered by the rule
+    covered = "covered"
+    # Sum of rule truth in excess of masked perm values
+    excess = "excess"
+    # Sum of rule truth up to masked perm values
+    overlap = "overlap"
+
+    # Allowance for rounding errors when bounding scores
+    tolerance = 1e-9
+
+    def __init__(self, kind, index, mask, universe=None, cache=None):
+        # Scores are read with this snapshot, so version has to match it
+        index.sync(universe)
+        self.kind = kind
+        self.mask = mask
+        self.vals = index.values().copy()
+        self.cover_thresh = index.cover_thresh
+        self.index = index
+        self.universe = universe
+        # Scores are memoized per index version, score kind and mask
+        self.cache = cache
+        self.version = index.version
+        self.key = (kind, mask.tostring())
+
+    def __call__(self, rule):
+        if self.cache is not None:
+            score = self.cache.get(self, rule)
+            if score is not None:
+                return score
+        score = self.fromTruth(self.index.truth(rule, self.universe))
+        if self.cache is not None:
+            self.cache.put(self, rule, score)
+        return score
+
+    def __getstate__(self):
+        """Excludes index, universe and cache, which are not needed."""
+        state = dict(self.__dict__)
+        state["index"], state["universe"], state["cache"] = None, None, None
+        return state
+
+    def bounds(self, truth, rows, cols):
+        """Returns lower bounds on scores of refinements by conditions.
+
+        Truths of the refined rule and rows of the conditions are given on
+        the target columns cols only. A refinement keeps the truth of the
+        rule on targets where the added literal is certainly true, and
+        scores only add up non-negative contributions of targets, so the
+        contributions of those targets bound the score without computing
+        the refined truths. Bounds of refinements by each condition are
+        followed by those by their negations, and allow for rounding.
+        """
+        mask, vals = self.mask[cols], self.vals[cols]
+        if self.kind == self.covered:
+            contrib = ((truth >= self.cover_thresh) & mask).astype(float)
+        elif self.kind == self.excess:
+            contrib = np.maximum(truth - vals, 0) * mask
+        elif self.kind == self.overlap:
+            contrib = np.minimum(truth, vals) * mask
+        else:
+            raise ValueError("Unknown score kind.")
+        bounds = np.concatenate([(rows == 1).dot(contrib),
+                                 (rows == 0).dot(contrib)])
+        return bounds - self.tolerance * (1 + len(cols))
+
+    def fromTruth(self, truth):
+        """Computes score from array of truth values."""
+        if self.kind == self.covered:
+            return float(np.count_nonzero((truth >= self.cover_thresh) &
+                                          self.mask))
+        elif self.kind == self.excess:
+            return float(np.maximum(truth - self.vals, 0)[self.mask].sum())
+        elif self.kind == self.overlap:
+            return float(np.minimum(truth, self.vals)[self.mask].sum())
+        raise ValueError("Unknown score kind.")
+
+class ScoreCache(object):
+    """Memoizes rule scores across searches on the same permissions.
+
+    Scores are stored per (score kind, mask) for the coverage index
+    version they were computed at, and are all dropped once a score is
+    requested for a newer version, i.e. when the permissions change.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.version = None
+        self._scores = dict() # Rule scores for each (kind, mask)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        """Removes all scores, but keeps hit statistics."""
+        self._scores.clear()
+        self._size = 0
+
+    def get(self, score_f, rule):
+        """Returns memoized score of rule, or None if absent."""
+        if score_f.version != self.version:
+            self.clear()
+            self.version = score_f.version
+        scores = self._scores.get(score_f.key)
+        score = None if scores is None else scores.get(rule)
+        if score is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return score
+
+    def put(self, score_f, rule, score):
+        """Memoizes score of rule, if computed at the current version."""
+        if score_f.version != self.version:
+            return
+        if self._size >= self.max_size:
+            self.clear()
+        scores = self._scores.setdefault(score_f.key, dict())
+        if rule not in scores:
+            self._size += 1
+        scores[rule] = score
+
+    def stats(self):
+        """Returns summary of cache size and hit rate."""
+        total = self.hits + self.misses
+        rate = float(self.hits) / total if total > 0 else 0.0
+        return "size={} hits={} misses={} hit_rate={:.3f}".\
+            format(self._size, self.hits, self.misses, rate)
+
+class CoverFilter(object):
+    """Accepts rules which cover a permission target."""
+
+    def __init__(self, index, tgt, universe=None):
+        self.col = index.cols[tgt]
+        self.cover_thresh = index.cover_thresh
+        self.index = index
+        self.universe = universe
+
+    def __call__(self, rule):
+        truth = self.index.truth(rule, self.universe, [self.col])[0]
+        return truth >= self.cover_thresh
+
+class InactiveFilter(object):
+    """Accepts rules which are not in a rule set."""
+
+    def __init__(self, rule_set):
+        self.rule_set = rule_set
+
+    def __call__(self, rule):
+        return rule not in self.rule_set
+
+class RuleTally(object):
+    """Running tally of rule set performance on permission targets.
+
+    Predictions are cached per target, so that a new or overwritten
+    permission updates the tally in constant time. Predictions are only
+    recomputed for new or modified targets, and for targets which are
+    covered by rules added to or removed from the rule set.
+    """
+
+    def __init__(self):
+        self.tgts = dict() # Latest target objects
+        self.truth = dict() # Permission values
+        self.predict = dict() # Cached rule set predictions
+        self.dirty = set() # Targets which need to be predicted
+        self.rules = frozenset() # Rules which predictions were made with
+        # Running sums of tp, tn, fp, fn, kept exact to avoid drift
+        self.sums = [Fraction(0)] * 4
+
+    def __len__(self):
+        return len(self.truth)
+
+    def clear(self):
+        """Removes all targets from the tally."""
+        self.__init__()
+
+    @staticmethod
+    def counts(truth, predict):
+        """Returns tp, tn, fp, fn values of a prediction."""
+        truth, predict = Fraction(truth), Fraction(float(predict))
+        tp = min(truth, predict)
+        tn = min(1-truth, 1-predict)
+        return [tp, tn, max(0, (1-truth)-tn), max(0, truth-tp)]
+
+    def add(self, truth, predict, sign=1):
+        """Adds (or subtracts) counts of a prediction to the sums."""
+        counts = self.counts(truth, predict)
+        self.sums = [x + sign * c for x, c in zip(self.sums, counts)]
+
+    @staticmethod
+    def summarize(sums, n_perms):
+        """Computes performance metrics from tp, tn, fp, fn sums."""
+        guard_div = lambda x, y, z: z if (y == 0) else x/y
+        tp, tn, fp, fn = [float(x) for x in sums]
+        prec = guard_div(tp, (tp + fp), 1)
+        rec = guard_div(tp, (tp + fn), 1)
+        acc = guard_div((tp + tn), n_perms, 1)
+        m_est = 0 # (tp + self.m_param * n_true/n_false) / (tp + fp)
+        return RuleMetrics(tp, tn, fp, fn, prec, rec, acc, m_est)
+
+    def invalidate(self, tgt):
+        """Removes the prediction of a target from the tally."""
+        if tgt in self.predict:
+            self.add(self.truth[tgt], self.predict.pop(tgt), -1)
+        self.dirty.add(tgt)
+
+    def setPerm(self, tgt, val):
+        """Adds or overwrites the permission value of a target."""
+        old = self.tgts.get(tgt)
+        if (tgt in self.predict and
+            getattr(old, "version", None) == getattr(tgt, "version", None)):
+            # Swap counts for the old value with those for the new one
+            self.add(self.truth[tgt], self.predict[tgt], -1)
+            self.add(val, self.predict[tgt])
+        else:
+            self.invalidate(tgt)
+        self.tgts[tgt] = tgt
+        self.truth[tgt] = val
+
+    def update(self, perms):
+        """Adds or overwrites multiple permissions, except untargeted ones."""
+        for tgt, val in perms.iteritems():
+            if tgt is not objects.Nil:
+                self.setPerm(tgt, val)
+
+    def metrics(self, rule_set, universe=None):
+        """Updates predictions of affected targets, returns metrics."""
+        rules = frozenset(rule_set)
+        changed = RuleSet(rules ^ self.rules)
+        if len(changed) > 0:
+            # Targets covered by changed rules need to be predicted again
+            tgts = [self.tgts[t] for t in self.predict]
+            if len(tgts) > 0:
+                covered = changed.evaluateBatch(tgts, universe) > 0
+                for tgt in [t for t, c in zip(tgts, covered) if c]:
+                    self.invalidate(tgt)
+            self.rules = rules
+        if len(self.dirty) > 0:
+            tgts = [self.tgts[t] for t in self.dirty]
+            predicts = rule_set.evaluateBatch(tgts, universe)
+            for tgt, predict in zip(tgts, predicts):
+                self.predict[tgt] = predict
+                self.add(self.truth[tgt], predict)
+            self.dirty.clear()
+        return self.summarize(self.sums, len(self.truth))
+
+class SearchSnapshot(object):
+    """Picklable snapshot used to refine and score rules in workers.
+
+    Rules are represented as frozensets of literals, where literal 2*k
+    is the k-th grounded condition and 2*k+1 is its negation. Truth rows
+    of the conditions are either pickled or placed in shared memory.
+    """
+
+    def __init__(self, rank, rows, score_f, cover_cols, inactive):
+        self.rank = rank # Canonical product order of each condition
+        self.shape = rows.shape # Shape of (conditions x targets) rows
+        self.rows = rows # Rows, or None if they are in shared memory
+        self.score_f = score_f # RuleScore of refined rules
+        self.cover_cols = cover_cols # Columns which rules must cover
+        self.inactive = inactive # Literal sets of rules to exclude
+
+    def getRows(self):
+        """Returns truth rows of the grounded conditions."""
+        if self.rows is not None:
+            return self.rows
+        size = self.shape[0] * self.shape[1]
+        return np.frombuffer(_search_buffer, count=size).reshape(self.shape)
+
+    def truth(self, rows, lits, cols=None):
+        """Returns truth of rule on all or the given targets.
+
+        Conditions are multiplied in the same order as CoverageIndex.truth,
+        so that scores are identical to those computed serially.
+        """
+        cols = slice(0, self.shape[1]) if cols is None else cols
+        truth = np.ones(self.shape[1])[cols]
+        for l in sorted(lits, key=lambda l : self.rank[l // 2]):
+            row = rows[l // 2][cols]
+            truth = truth * ((1-row) if l % 2 else row)
+        return truth
+
+    def refine(self, jobs):
+        """Refines (literals, condition) jobs, returns accepted scores."""
+        rows = self.getRows()
+        results = []
+        support = dict() # Targets covered by each refined literal set
+        for lits, k in jobs:
+            # Check for idempotency / complementation
+            if 2*k in lits or 2*k+1 in lits:
+                continue
+            # Skip conditions which do not split the covered targets
+            if lits not in support:
+                support[lits] = np.flatnonzero(self.truth(rows, lits) > 0)
+            row = rows[k][support[lits]]
+            if np.all(row == 0) or np.all(row == 1):
+                continue
+            for new in [lits | frozenset([2*k]), lits | frozenset([2*k+1])]:
+                if new in self.inactive:
+                    continue
+                # Check coverage before computing truth on all targets
+                if (len(self.cover_cols) > 0 and
+                    np.any(self.truth(rows, new, self.cover_cols) <
+                           self.score_f.cover_thresh)):
+                    continue
+                truth = self.truth(rows, new)
+                results.append((new, self.score_f.fromTruth(truth)))
+        return results
+
+def refineJobs(args):
+    """Refines and scores a chunk of jobs (run by worker processes)."""
+    snapshot, jobs = args
+    return snapshot.refine(jobs)
+
+# Shared memory for condition rows, allocated before workers are forked
+_search_buffer = None
+
+class SearchBudget(object):
+    """Bounds the wall-clock time and number of rules scored by a search.
+
+    A limit of zero (or less) means that the quantity is unbounded.
+    """
+
+    def __init__(self, time_limit=0.0, max_scored=0):
+        self.start = time.time()
+        self.deadline = (self.start + time_limit if time_limit > 0
+                         else None)
+        self.max_scored = max_scored
+        self.n_scored = 0
+
+    def spend(self, n=1):
+        """Records that n more rules were scored."""
+        self.n_scored += n
+
+    def remaining(self):
+        """Returns number of rules that may still be scored, or None."""
+        if self.max_scored <= 0:
+            return None
+        return max(0, self.max_scored - self.n_scored)
+
+    def timeLeft(self):
+        """Returns seconds left until the deadline, or None."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def exhausted(self):
+        """Returns true if the time or scoring budget has been used up."""
+        return (self.remaining() == 0 or
+                (self.deadline is not None and time.time() >= self.deadline))
+
+class RuleSearch(object):
+    """General to specific search for rules, in worker processes if any.
+
+    Refinements are scored in worker processes if there are any and the
+    scores can be sent to them, and serially otherwise. If exhaustive is
+    set, serial searches score every refinement instead of pruning them.
+    """
+
+    def __init__(self, max_rule_conds=4, max_cand_rules=3, workers=0,
+                 par_min=256, buf_size=2**22, time_limit=0.0, max_scored=0,
+                 exhaustive=False):
+        self.max_rule_conds = max_rule_conds # Maximum depth of search
+        self.max_cand_rules = max_cand_rules # Beam width of search
+        self.workers = workers # Number of worker processes
+        self.par_min = par_min # Minimum refinements to search in parallel
+        self.time_limit = time_limit # Default time limit per search
+        self.max_scored = max_scored # Default rules scored per search
+        self.exhaustive = exhaustive
+        # Lock to ensure that one search at a time uses the workers
+        self.lock = threading.Lock()
+        self.pool = None
+        self.buf_size = buf_size
+        if self.workers > 0:
+            # Workers can only share the buffer allocated before forking
+            global _search_buffer
+            if _search_buffer is None:
+                _search_buffer = multiprocessing.RawArray('d', buf_size)
+            self.buf_size = len(_search_buffer)
+            self.pool = multiprocessing.Pool(self.workers)
+
+    def getPool(self):
+        """Returns pool of workers, restarting it if it was terminated."""
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        return self.pool
+
+    def search(self, init_rule, score_thresh, score_f, filters=[],
+               universe=None, budget=None):
+        """Performs general to specific search for minimal-scoring rule.
+
+        The search is anytime: once the budget (by default, the search
+        time and scoring limits) is used up, the best rule found so far
+        is returned.
+        """
+        # Fetch universes once for the whole search
+        if universe is None:
+            universe = Universe()
+        if budget is None:
+            budget = SearchBudget(self.time_limit, self.max_scored)
+        best_rule, best_score = init_rule, score_f(init_rule)
+        budget.spend()
+        cand_rules = [best_rule]
+        success = (all([f(init_rule) for f in filters]) and
+                   best_score <= score_thresh)
+        n_conds = len(init_rule.conditions)
+        while (len(cand_rules) > 0 and n_conds <= self.max_rule_conds):
+            # Terminate if score beats threshold
+            if success:
+                break
+            # Terminate with best rule so far if budget is used up
+            if budget.exhausted():
+                rospy.loginfo(("Search budget hit after scoring %d rules " +
+                               "in %.3fs, returning [%s]."),
+                              budget.n_scored, time.time() - budget.start,
+                              best_rule.toPrint())
+                break
+            # Refine previous candidates, keeping the top few by score
+            n_top = max(1, self.max_cand_rules)
+            sort_rules = self.refineParallel(cand_rules, n_top, score_f,
+                                             filters, universe, budget)
+            if sort_rules is None:
+                sort_rules = self.refineSerial(cand_rules, n_top, score_f,
+                                               filters, universe, budget)
+            n_conds += 1
+            # Return if no more rules
+            if len(sort_rules) == 0:
+                return best_rule, best_score, success
+            # Select top few candidates for next round of refinement
+            cand_rules = [r for r, s in sort_rules[0:self.max_cand_rules]]
+            # Check if best candidate beats best rule
+            if len(sort_rules) > 0 and sort_rules[0][1] < best_score:
+                best_rule, best_score = sort_rules[0]
+                success = best_score <= score_thresh
+        return best_rule, best_score, success
+
+    def refineSerial(self, cand_rules, n_top, score_f, filters,
+                     universe=None, budget=None):
+        """Returns top refinements of candidates as (rule, score) pairs.
+
+        If scores can be bounded, refinements which do not split the
+        targets covered by their candidates are skipped, and the rest are
+        scored in ascending order of their bounds, stopping once none of
+        them can make the top few.
+        """
+        if budget is None:
+            budget = SearchBudget()
+        if self.exhaustive or not isinstance(score_f, RuleScore):
+            return self.refineExhaustive(cand_rules, n_top, score_f, filters,
+                                         universe, budget)
+        # Merge lazy refinements of all candidates, ordered by bound
+        def tag(i, refinements):
+            for bound, pos, r in refinements:
+                yield bound, i, pos, r
+        merged = heapq.merge(*[tag(i, c.refineRelevant(score_f.index,
+                                                       score_f.bounds,
+                                                       universe))
+                               for i, c in enumerate(cand_rules)])
+        # Keep top few by score, breaking ties in the order of refine
+        top = []
+        for bound, i, pos, r in merged:
+            if len(top) >= n_top and bound > top[-1][0]:
+                break
+            if budget.exhausted():
+                break
+            if not all(f(r) for f in filters):
+                continue
+            bisect.insort(top, (score_f(r), i, pos, r))
+            budget.spend()
+            del top[n_top:]
+        return [(r, s) for s, i, pos, r in top]
+
+    def refineExhaustive(self, cand_rules, n_top, score_f, filters,
+                         universe=None, budget=None):
+        """Scores all refinements of candidates (c.f. refineSerial)."""
+        # Construct list of refinements from previous candidates
+        new_rules = [r.refine(universe) for r in cand_rules]
+        new_rules = [r for l in new_rules for r in l]
+        # Select rules which match filters
+        for f in filters:
+            new_rules = filter(f, new_rules)
+        # Compute and sort by scores, until the budget is used up
+        if budget is None:
+            budget = SearchBudget()
+        scores = []
+        for r in new_rules:
+            if budget.exhausted():
+                break
+            scores.append(score_f(r))
+            budget.spend()
+        sort_rules = sorted(zip(new_rules, scores), key=lambda p:p[1])
+        return sort_rules[0:n_top]
+
+    def refineParallel(self, cand_rules, n_top, score_f, filters,
+                       universe=None, budget=None):
+        """Refines candidates in worker processes (c.f. refineSerial).
+
+        Returns None if there are no workers, too few refinements, or if
+        the scores, filters or candidates cannot be sent to the workers.
+        If the deadline passes, the workers are terminated so that no
+        chunks are left running, and the results so far are returned.
+        """
+        if self.workers <= 0 or not isinstance(score_f, RuleScore):
+            return None
+        if any(type(f) not in [CoverFilter, InactiveFilter] for f in filters):
+            return None
+        conditions = Rule.groundings(universe)
+        if 2 * len(conditions) * len(cand_rules) < self.par_min:
+            return None
+        # Represent candidates as literals, if all conditions are grounded
+        lit_db = dict((p, 2*k) for k, p in enumerate(conditions))
+        lit_db.update((p.negate(), 2*k+1) for k, p in enumerate(conditions))
+        toLits = lambda r : (frozenset(lit_db[p] for p in r.conditions)
+                             if all(p in lit_db for p in r.conditions)
+                             else None)
+        cand_lits = [toLits(r) for r in cand_rules]
+        if None in cand_lits:
+            return None
+        # Literal sets of excluded rules (others can never be refinements)
+        inactive = [toLits(r) for f in filters
+                    if isinstance(f, InactiveFilter) for r in f.rule_set]
+        inactive = set(l for l in inactive if l is not None)
+        cover_cols = [f.col for f in filters if isinstance(f, CoverFilter)]
+        order = sorted(range(len(conditions)),
+                       key=lambda k : CoverageIndex.order(conditions[k]))
+        rank = [0] * len(order)
+        for i, k in enumerate(order):
+            rank[k] = i
+
+        # Search serially if another action is using the workers
+        if not self.lock.acquire(False):
+            return None
+        try:
+            rows = score_f.index.rows(conditions, universe)
+            snapshot = SearchSnapshot(rank, rows, score_f, cover_cols,
+                                      inactive)
+            # Place rows in shared memory if they fit
+            if rows.size <= self.buf_size:
+                np.frombuffer(_search_buffer, count=rows.size)[:] = \
+                    rows.ravel()
+                snapshot.rows = None
+            # Split jobs into contiguous chunks, in the order of refine
+            jobs = [(l, k) for l in cand_lits
+                    for k in range(len(conditions))]
+            if budget is None:
+                budget = SearchBudget()
+            # Each job scores at most two rules
+            n_left = budget.remaining()
+            if n_left is not None:
+                jobs = jobs[:(n_left + 1) // 2]
+            n_chunks = self.workers
+            # Use smaller chunks so that most finish before the deadline
+            if budget.deadline is not None:
+                n_chunks *= 4
+            size = max(1, (len(jobs) + n_chunks - 1) // n_chunks)
+            chunks = [(snapshot, jobs[i:i+size])
+                      for i in range(0, len(jobs), size)]
+            results = []
+            it = self.getPool().imap(refineJobs, chunks)
+            for i in range(len(chunks)):
+                try:
+                    results.append(it.next(budget.timeLeft()))
+                except multiprocessing.TimeoutError:
+                    # Stop outstanding chunks in the background, without
+                    # overrunning the deadline, and restart when needed
+                    pool, self.pool = self.pool, None
+                    threading.Thread(target=pool.terminate).start()
+                    break
+        finally:
+            self.lock.release()
+        results = [r for l in results for r in l][:n_left]
+        budget.spend(len(results))
+
+        # Convert only the top few literal sets back to rules
+        sort_lits = sorted(results, key=lambda p:p[1])[0:n_top]
+        action, detype = cand_rules[0].action, cand_rules[0].detype
+        sort_rules = [(Rule(action, [conditions[l // 2] if l % 2 == 0 else
+                                     conditions[l // 2].negate()
+                                     for l in lits], detype).intern(), s)
+                      for lits, s in sort_lits]
+        # Memoize scores of the returned rules for later searches
+        if score_f.cache is not None:
+            for r, s in sort_rules:
+                score_f.cache.put(score_f, r, s)
+        return sort_rules
+
+class RuleStore(object):
+    """Write-ahead log and snapshots of the rule manager's databases.
+
+    Changes are appended to numbered log segments. A checkpoint starts a
+    new segment before taking a snapshot, and the snapshot records which
+    segment to replay from, so no logged change is lost. Replaying a
+    change that the snapshot already contains is harmless, since each
+    record sets (rather than modifies) a value.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snap_path = os.path.join(path, "snapshot")
+        self.segment = 0 # Number of the segment being appended to
+        self.log = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def packRule(msg):
+        """Converts rule message to tuple of builtin types."""
+        return (msg.action, msg.detype, msg.truth,
+                tuple((c.predicate, tuple(c.bindings), c.negated, c.truth)
+                      for c in msg.conditions))
+
+    @staticmethod
+    def unpackRule(packed):
+        """Converts tuple of builtin types to rule message."""
+        action, detype, truth, conditions = packed
+        conditions = [PredicateMsg(predicate=p, bindings=list(b),
+                                   negated=n, truth=t)
+                      for p, b, n, t in conditions]
+        return RuleMsg(action=action, conditions=conditions,
+                       detype=detype, truth=truth)
+
+    def segPath(self, n):
+        """Returns path of n-th log segment."""
+        return os.path.join(self.path, "wal.{:08d}".format(n))
+
+    def segments(self):
+        """Returns sorted numbers of existing log segments."""
+        return sorted(int(f.split(".")[1]) for f in os.listdir(self.path)
+                      if f.startswith("wal."))
+
+    def load(self):
+        """Returns last snapshot (or None) and records logged since."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        snapshot = None
+        if os.path.exists(self.snap_path):
+            with open(self.snap_path, "rb") as f:
+                snapshot = cPickle.load(f)
+        start = 0 if snapshot is None else snapshot["segment"]
+        records = []
+        for n in self.segments():
+            if n >= start:
+                records += self.readSegment(n)
+        # Append to a fresh segment, in case the last one was torn
+        self.segment = max(self.segments() + [start]) + 1
+        self.log = open(self.segPath(self.segment), "ab")
+        return snapshot, records
+
+    def readSegment(self, n):
+        """Returns records in a segment, up to any torn record."""
+        records = []
+        with open(self.segPath(n), "rb") as f:
+            while True:
+                try:
+                    records.append(cPickle.load(f))
+                except EOFError:
+                    break
+                except Exception:
+                    rospy.logwarn("Ignoring torn record in %s",
+                                  self.segPath(n))
+                    break
+        return records
+
+    def append(self, record):
+        """Appends record to log and flushes it to disk."""
+        self.appendBatch([record])
+
+    def appendBatch(self, records):
+        """Appends records to log, flushing them to disk only once."""
+        with self.lock:
+            for record in records:
+                cPickle.dump(record, self.log, 2)
+            self.log.flush()
+            os.fsync(self.log.fileno())
+
+    def rotate(self):
+        """Starts a new log segment, returning its number."""
+        with self.lock:
+            self.log.close()
+            self.segment += 1
+            self.log = open(self.segPath(self.segment), "ab")
+            return self.segment
+
+    def checkpoint(self, state, segment):
+        """Writes snapshot to replay from segment, removes older ones."""
+        state["segment"] = segment
+        tmp_path = self.snap_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            cPickle.dump(state, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snap_path)
+        for n in self.segments():
+            if n < segment:
+                os.remove(self.segPath(n))
+
 class RuleManager(object):
     """Manages, updates and learns (ownership) rules."""
     
@@ -25,6 +737,26 @@ class RuleManager(object):
         self.max_cand_rules = rospy.get_param("~max_cand_rules", 3)
         self.max_rule_conds = rospy.get_param("~max_rule_conds", 4)
         self.m_param = rospy.get_param("~m_param", 3)
+
+        # Number of processes to refine rules with, 0 to search serially
+        self.search_workers = rospy.get_param("~search_workers", 0)
+        # Minimum number of refinements before searching in parallel
+        self.search_par_min = rospy.get_param("~search_par_min", 256)
+        # Number of truth values which can be shared with the workers
+        self.search_buf_size = rospy.get_param("~search_buf_size", 2**22)
+        # Seconds and number of rules scored per search, 0 for no limit
+        self.search_time_limit = rospy.get_param("~search_time_limit", 0.0)
+        self.search_max_scored = rospy.get_param("~search_max_scored", 0)
+        self.searcher = RuleSearch(self.max_rule_conds, self.max_cand_rules,
+                                   self.search_workers, self.search_par_min,
+                                   self.search_buf_size,
+                                   self.search_time_limit,
+                                   self.search_max_scored)
+
+        # Maximum number of cached predicate truth values
+        predicates.cache.max_size = rospy.get_param("~cache_size", 10000)
+        # Maximum number of memoized rule scores per action
+        self.score_cache_size = rospy.get_param("~score_cache_size", 100000)
         
         # Database of active rules
         self.rule_db = dict()
@@ -32,35 +764,97 @@ class RuleManager(object):
         self.perm_db = dict()
         # Database of unexplained permissions
         self.unexplained_db = dict()
+        # Coverage of rule conditions over permission targets
+        self.index_db = dict()
+        # Running performance of active rules on permission targets
+        self.tally_db = dict()
+        # Published (version, rules, messages) of each active rule set
+        self.pub_rule_db = dict()
+        # Memoized scores of candidate rules for the current permissions
+        self.score_db = dict()
+
+        # Locks to ensure permissions of each action update synchronously
+        self.perm_locks = dict()
+        # Locks to ensure rules and coverage of each action are updated
+        # synchronously (lookups use published snapshots instead)
+        self.rule_locks = dict()
+        # Lock for the learning queue, signalling when perms are pending
+        self.queue_lock = threading.Lock()
+        self.queue_cond = threading.Condition(self.queue_lock)
 
-        # Lock to ensure callbacks update permissions synchronously
-        self.perm_lock = threading.Lock()
-        # Lock to ensure callbacks update rules synchronously
-        self.rule_lock = threading.Lock()
+        # Whether to learn each action in its own thread
+        self.learn_per_action = rospy.get_param("~learn_per_action", False)
+        # Permissions awaiting the learner (latest value per target)
+        self.pending_db = dict()
+        # Given rules awaiting the learner, in order of arrival
+        self.pending_rules = dict()
+        # Receipt time of oldest pending permission or rule for each action
+        self.pending_times = dict()
+        # Receipt time of oldest permission or rule in each batch learned
+        self.learn_times = dict()
+        # Number of batches learned, size and duration of the last one
+        self.n_batches = 0
+        self.last_batch = 0
+        self.last_duration = 0.0
         
         # Certainty threshold to consider a permission 'covered'
         self.cover_thresh = rospy.get_param("~cover_thresh", 0.5)
         # Prior probability that permission is 'forbid'
         self.perm_prior = rospy.get_param("~perm_prior", 0.0)
         
+        # Seconds between minimizations of rule sets, 0 to disable
+        self.minimize_interval = rospy.get_param("~minimize_interval", 0.0)
+
         # Whether rule and permission databases are frozen
         self.freeze_perms = rospy.get_param("~freeze_perms", False)
         self.freeze_rules = rospy.get_param("~freeze_rules", False)
 
         # Initialize databases with empty dicts/sets
         for a in actions.db.iterkeys():
-            self.rule_db[a] = set()
+            self.rule_db[a] = RuleSet()
             self.perm_db[a] = dict()
             self.unexplained_db[a] = dict()
+            self.index_db[a] = CoverageIndex(self.cover_thresh)
+            self.tally_db[a] = RuleTally()
+            self.pub_rule_db[a] = (1, frozenset(), [])
+            self.score_db[a] = ScoreCache(self.score_cache_size)
+            self.pending_db[a] = dict()
+            self.pending_rules[a] = []
+            self.perm_locks[a] = threading.Lock()
+            self.rule_locks[a] = threading.Lock()
 
         # Do not use inferred ownership values when learning rules
         Object.use_inferred = False
+
+        # Directory to persist databases in, or empty to keep in memory
+        self.store_path = rospy.get_param("~store_path", "")
+        # Seconds between checkpoints of persisted databases, 0 to disable
+        self.checkpoint_interval = rospy.get_param("~checkpoint_interval",
+                                                   300.0)
+        # Lock to ensure one checkpoint at a time
+        self.checkpoint_lock = threading.Lock()
+        self.store = None
+        if self.store_path != "":
+            self.store = RuleStore(os.path.expanduser(self.store_path))
+            self.restore()
+            if self.checkpoint_interval > 0:
+                rospy.Timer(rospy.Duration(self.checkpoint_interval),
+                            lambda event : self.checkpoint())
             
+        # Publishers
+        self.rule_pub = rospy.Publisher("rule_updates", RuleUpdateMsg,
+                                        queue_size=10, latch=True)
         # Subscribers
         self.perm_sub = rospy.Subscriber("perm_input", PredicateMsg,
                                          self.permInputCb)
         self.rule_sub = rospy.Subscriber("rule_input", RuleMsg,
                                          self.ruleInputCb)
+        self.perm_arr_sub = rospy.Subscriber("perm_array_input",
+                                             PredicateArrayMsg,
+                                             self.permArrayInputCb)
+        self.rule_arr_sub = rospy.Subscriber("rule_array_input",
+                                             RuleArrayMsg,
+                                             self.ruleArrayInputCb)
         # Servers
         self.lkp_perm_srv = rospy.Service("lookup_perm", LookupPerm,
                                            self.lookupPermCb)
@@ -74,22 +868,64 @@ class RuleManager(object):
                                           self.freezePermsCb)
         self.frz_rule_srv = rospy.Service("freeze_rules", SetBool,
                                           self.freezeRulesCb)
+        self.cache_srv = rospy.Service("cache_stats", Trigger,
+                                       self.cacheStatsCb)
+        self.learn_srv = rospy.Service("learner_stats", Trigger,
+                                       self.learnerStatsCb)
+        self.ckpt_srv = rospy.Service("checkpoint", Trigger,
+                                      self.checkpointCb)
+        self.induce_srv = rospy.Service("induce_rules", InduceRules,
+                                        self.induceRulesCb)
+        self.min_srv = rospy.Service("minimize_rules", Trigger,
+                                     self.minimizeRulesCb)
+        # Minimize rule sets periodically
+        if self.minimize_interval > 0:
+            rospy.Timer(rospy.Duration(self.minimize_interval),
+                        lambda event : self.minimizeAll())
+
+        # Learn rules in the background so that callbacks return quickly
+        if self.learn_per_action:
+            groups = [set([a]) for a in actions.db.iterkeys()]
+        else:
+            groups = [set(actions.db.iterkeys())]
+        self.learners = [threading.Thread(target=self.learnLoop, args=(g,))
+                         for g in groups]
+        for learner in self.learners:
+            learner.daemon = True
+            learner.start()
 
     def resetPermsCb(self, req):
         """Clears the permission database."""
-        self.perm_lock.acquire()
         for a in actions.db.iterkeys():
+            self.perm_locks[a].acquire()
+            self.logChange(("reset_perms", a))
+            self.queue_lock.acquire()
             self.perm_db[a].clear()
+            self.pending_db[a].clear()
+            if len(self.pending_rules[a]) == 0:
+                self.pending_times.pop(a, None)
+            self.queue_lock.release()
+            self.perm_locks[a].release()
+            self.rule_locks[a].acquire()
             self.unexplained_db[a].clear()
-        self.perm_lock.release()
+            self.index_db[a].clear()
+            self.tally_db[a].clear()
+            self.rule_locks[a].release()
         return TriggerResponse(True, "")
 
     def resetRulesCb(self, req):
         """Clears the given rule and active rule databases."""
-        self.rule_lock.acquire()
         for a in actions.db.iterkeys():
+            # Drop given rules which have not been accommodated yet
+            self.queue_lock.acquire()
+            del self.pending_rules[a][:]
+            if len(self.pending_db[a]) == 0:
+                self.pending_times.pop(a, None)
+            self.queue_lock.release()
+            self.rule_locks[a].acquire()
             self.rule_db[a].clear()
-        self.rule_lock.release()
+            self.publishRules(a)
+            self.rule_locks[a].release()
         return TriggerResponse(True, "")
 
     def freezePermsCb(self, req):
@@ -102,6 +938,69 @@ class RuleManager(object):
         self.freeze_rules = req.data
         return SetBoolResponse(True, "")
     
+    def checkpointCb(self, req):
+        """Checkpoints persisted databases."""
+        if self.store is None:
+            return TriggerResponse(False, "Databases are not persisted.")
+        return TriggerResponse(True, self.checkpoint())
+
+    def induceRulesCb(self, req):
+        """Replaces rules for an action with rules induced in batch."""
+        if req.action not in self.rule_db:
+            rospy.logwarn("Action %s not recognized, cannot induce rules.",
+                          req.action)
+            return InduceRulesResponse(False, "Unknown action.", 0, [])
+        if self.freeze_rules:
+            return InduceRulesResponse(False, "Rules are frozen.", 0, [])
+        # Refresh permission targets before inducing rules
+        perm_set = self.refreshTargets(req.action)
+        universe = Universe()
+        start = time.time()
+        with self.rule_locks[req.action]:
+            self.index_db[req.action].update(perm_set)
+            self.tally_db[req.action].update(perm_set)
+            rule_set = self.induceRules(req.action, perm_set.keys(),
+                                        universe)
+            self.rule_db[req.action] = rule_set
+            # Induced rules account for all permissions
+            self.unexplained_db[req.action].clear()
+            self.logUnexplained(req.action)
+            self.publishRules(req.action)
+            version, rules, rule_msgs = self.pub_rule_db[req.action]
+            metrics = self.tally_db[req.action].metrics(rule_set, universe)
+        stats = "perms: {} rules: {} accuracy: {:.3f} duration: {:.3f}s".\
+            format(len(perm_set), len(rule_set), metrics.accuracy,
+                   time.time() - start)
+        rospy.loginfo("Induced rules for %s, %s", req.action, stats)
+        return InduceRulesResponse(True, stats, version, rule_msgs)
+
+    def minimizeRulesCb(self, req):
+        """Minimizes rule sets and reports their sizes and speeds."""
+        if self.freeze_rules:
+            return TriggerResponse(False, "Rules are frozen.")
+        return TriggerResponse(True, self.minimizeAll())
+
+    def cacheStatsCb(self, req):
+        """Reports size and hit rate of the truth and score caches."""
+        stats = ["truth: " + predicates.cache.stats()]
+        for a in sorted(self.score_db.iterkeys()):
+            stats.append("scores[{}]: {}".format(a, self.score_db[a].stats()))
+        return TriggerResponse(True, "\n".join(stats))
+
+    def learnerStatsCb(self, req):
+        """Reports queue depth and lag of the background rule learner."""
+        self.queue_lock.acquire()
+        depth = (sum(len(p) for p in self.pending_db.itervalues()) +
+                 sum(len(r) for r in self.pending_rules.itervalues()))
+        times = self.pending_times.values() + self.learn_times.values()
+        lag = rospy.get_time() - min(times) if len(times) > 0 else 0.0
+        stats = ("depth: {} lag: {:.3f}s batches: {} " +
+                 "last size: {} last duration: {:.3f}s").\
+            format(depth, lag, self.n_batches,
+                   self.last_batch, self.last_duration)
+        self.queue_lock.release()
+        return TriggerResponse(True, stats)
+
     def lookupPermCb(self, req):
         """Returns action permission for requested action-target pair."""
         if req.action in self.perm_db:
@@ -115,17 +1014,162 @@ class RuleManager(object):
         return LookupPermResponse(-1)
         
     def lookupRulesCb(self, req):
-        """Returns rule set for requested action."""
-        if req.action in self.rule_db:
-            rule_set = [r.toMsg() for r in self.rule_db[req.action]]
+        """Returns rule set for requested action, unless version is known."""
+        if req.action in self.pub_rule_db:
+            version, rules, rule_msgs = self.pub_rule_db[req.action]
+            if req.version == version:
+                return LookupRulesResponse(True, version, [])
+            return LookupRulesResponse(False, version, rule_msgs)
         else:
-            rule_set = []
             rospy.logwarn("Action %s not recognized, no rules to lookup.",
                           req.action)
-        return LookupRulesResponse(rule_set)
+            return LookupRulesResponse(False, 0, [])
+
+    def publishRules(self, act_name):
+        """Updates version of rule set and publishes changes, if any."""
+        version, old, old_msgs = self.pub_rule_db[act_name]
+        new = frozenset(self.rule_db[act_name])
+        if new == old:
+            return
+        version += 1
+        self.pub_rule_db[act_name] = (version, new,
+                                      [r.toMsg() for r in new])
+        msg = RuleUpdateMsg(action=act_name, version=version,
+                            added=[r.toMsg() for r in new - old],
+                            removed=[r.toMsg() for r in old - new])
+        self.logChange(("rules", act_name, version,
+                        [RuleStore.packRule(m) for m in msg.added],
+                        [RuleStore.packRule(m) for m in msg.removed]))
+        self.rule_pub.publish(msg)
+
+    def logChange(self, record):
+        """Appends change record to the write-ahead log, if persisting."""
+        if self.store is not None:
+            self.store.append(record)
+
+    def logChanges(self, records):
+        """Appends change records to the write-ahead log in one write."""
+        if self.store is not None and len(records) > 0:
+            self.store.appendBatch(records)
+
+    def logUnexplained(self, act_name, batch=None):
+        """Logs perms added to the unexplained ones, or clearing if None."""
+        if batch is None:
+            self.logChange(("unexplained_clear", act_name))
+        elif len(batch) > 0:
+            self.logChange(("unexplained_add", act_name,
+                            [(t.toStr(), v) for t, v in batch.iteritems()]))
+
+    def checkpoint(self):
+        """Snapshots persisted databases so that the log can be cleared."""
+        self.checkpoint_lock.acquire()
+        start = rospy.get_time()
+        # Changes from here on are logged to a new segment
+        segment = self.store.rotate()
+        state = {"perms": dict(), "unexplained": dict(), "rules": dict()}
+        for a in actions.db.iterkeys():
+            self.perm_locks[a].acquire()
+            state["perms"][a] = [(t.toStr(), v) for t, v in
+                                 self.perm_db[a].iteritems()]
+            self.perm_locks[a].release()
+            self.rule_locks[a].acquire()
+            state["unexplained"][a] = [(t.toStr(), v) for t, v in
+                                       self.unexplained_db[a].iteritems()]
+            self.rule_locks[a].release()
+            version, rules, rule_msgs = self.pub_rule_db[a]
+            state["rules"][a] = (version, [RuleStore.packRule(m)
+                                           for m in rule_msgs])
+        self.store.checkpoint(state, segment)
+        n_perms = sum(len(p) for p in state["perms"].itervalues())
+        status = "Checkpointed {} perms in {:.3f}s".\
+            format(n_perms, rospy.get_time() - start)
+        self.checkpoint_lock.release()
+        rospy.loginfo(status)
+        return status
+
+    def restore(self):
+        """Restores persisted databases from snapshot and logged changes."""
+        start = rospy.get_time()
+        # Skip garbage collection while building many small objects
+        gc.disable()
+        try:
+            self.restoreDatabases()
+        finally:
+            gc.enable()
+        n_perms = sum(len(p) for p in self.perm_db.itervalues())
+        n_rules = sum(len(r) for r in self.rule_db.itervalues())
+        rospy.loginfo("Restored %d perms and %d rules in %.3fs",
+                      n_perms, n_rules, rospy.get_time() - start)
+
+    def restoreDatabases(self):
+        """Replays persisted changes and rebuilds the databases."""
+        snapshot, records = self.store.load()
+        # Replay changes on databases keyed by target strings
+        perms = dict((a, dict()) for a in actions.db.iterkeys())
+        unexplained = dict((a, dict()) for a in actions.db.iterkeys())
+        rules = dict((a, (1, set())) for a in actions.db.iterkeys())
+        if snapshot is not None:
+            for a, items in snapshot["perms"].iteritems():
+                perms[a] = dict(items)
+            for a, items in snapshot["unexplained"].iteritems():
+                unexplained[a] = dict(items)
+            for a, (version, packed) in snapshot["rules"].iteritems():
+                rules[a] = (version, set(self.unpackRule(p) for p in packed))
+        for record in records:
+            if record[0] == "perm":
+                perms[record[1]][record[2]] = record[3]
+            elif record[0] == "reset_perms":
+                perms[record[1]].clear()
+                unexplained[record[1]].clear()
+            elif record[0] == "unexplained_add":
+                unexplained[record[1]].update(record[2])
+            elif record[0] == "unexplained_clear":
+                unexplained[record[1]].clear()
+            elif record[0] == "unexplained":
+                # Whole unexplained perms, as logged by older versions
+                unexplained[record[1]] = dict(record[2])
+            elif record[0] == "rules":
+                rule_set = rules[record[1]][1]
+                rule_set.difference_update(self.unpackRule(p)
+                                           for p in record[4])
+                rule_set.update(self.unpackRule(p) for p in record[3])
+                rules[record[1]] = (record[2], rule_set)
+
+        # Parse targets without looking up each one, then refresh in bulk
+        tgt_db = dict()
+        for a in actions.db.iterkeys():
+            for s in perms[a].keys() + unexplained[a].keys():
+                if (a, s) not in tgt_db:
+                    tgt_db[(a, s)] = self.parseTarget(actions.db[a], s)
+        keys = tgt_db.keys()
+        tgts = objects.refreshBatch([tgt_db[k] for k in keys], False)
+        tgt_db = dict(zip(keys, tgts))
+        for a in actions.db.iterkeys():
+            self.perm_db[a] = dict((tgt_db[(a, s)], v) for s, v in
+                                   perms[a].iteritems())
+            self.unexplained_db[a] = dict((tgt_db[(a, s)], v) for s, v in
+                                          unexplained[a].iteritems())
+            self.index_db[a].update(self.perm_db[a])
+            self.tally_db[a].update(self.perm_db[a])
+            version, rule_set = rules[a]
+            self.rule_db[a] = RuleSet(rule_set)
+            self.pub_rule_db[a] = (version, frozenset(rule_set),
+                                   [r.toMsg() for r in rule_set])
+
+    def unpackRule(self, packed):
+        """Converts persisted tuple to rule."""
+        return Rule.fromMsg(RuleStore.unpackRule(packed))
+
+    def parseTarget(self, action, s):
+        """Converts string to target without looking up objects."""
+        if action.tgtype is type(None):
+            return objects.Nil
+        elif action.tgtype is Object:
+            return Object(id=int(s))
+        return action.tgtype.fromStr(s)
         
     def permInputCb(self, msg):
-        """Updates database with new permission, then accommodates rules."""
+        """Updates database with new permission, queues it for learning."""
         # Do nothing if perm database is frozen
         if self.freeze_perms:
             return
@@ -135,132 +1179,262 @@ class RuleManager(object):
             return
 
         action = actions.db[msg.predicate]
-        
+        tgt = self.parsePerm(action, msg)
+        self.addPerms(action.name, [(tgt, msg.truth)])
+
+    def permArrayInputCb(self, msg):
+        """Updates database with batch of permissions, queues them."""
+        # Do nothing if perm database is frozen
+        if self.freeze_perms:
+            return
+
+        # Parse targets without looking up objects one by one
+        perms = []
+        for m in msg.predicates:
+            # Ignore perms which are not about actions
+            if m.predicate not in actions.db:
+                continue
+            action = actions.db[m.predicate]
+            try:
+                tgt = self.parsePerm(action, m, lookup=False)
+            except (TypeError, ValueError) as e:
+                rospy.logwarn("Ignoring perm for %s: %s", action.name, e)
+                continue
+            perms.append((action.name, tgt, m.truth))
+        # Refresh all object targets at once
+        tgts = objects.refreshBatch([t for a, t, v in perms])
+
+        # Add permissions for each action at once
+        perm_db = defaultdict(list)
+        for (act_name, old, truth), tgt in zip(perms, tgts):
+            perm_db[act_name].append((tgt, truth))
+        for act_name, act_perms in perm_db.iteritems():
+            self.addPerms(act_name, act_perms)
+
+    def parsePerm(self, action, msg, lookup=True):
+        """Returns target of action permission message."""
         # Handle actions without targets
         if len(msg.bindings) != 1:
             raise TypeError("Action perm should have exactly one argument.")
         if (msg.bindings[0] == objects.Nil.toStr() and
             action.tgtype is type(None)):
-            self.perm_lock.acquire()
-            self.perm_db[action.name][objects.Nil] = msg.truth
-            self.perm_lock.release()
-            return
-        
-        tgt = action.tgtype.fromStr(msg.bindings[0])
-        
-        self.perm_lock.acquire()
-        # Overwrite old value if permission already exists
-        self.perm_db[action.name][tgt] = msg.truth
+            return objects.Nil
+        elif lookup:
+            return action.tgtype.fromStr(msg.bindings[0])
+        else:
+            return self.parseTarget(action, msg.bindings[0])
+
+    def addPerms(self, act_name, perms):
+        """Adds (target, truth) perms for an action, queues them."""
+        self.perm_locks[act_name].acquire()
+        # Log whole batch before applying it, outside of the queue lock,
+        # but under the permission lock so that records stay in order
+        self.logChanges([("perm", act_name, tgt.toStr(), truth)
+                         for tgt, truth in perms])
+        for tgt, truth in perms:
+            # Overwrite old value if permission already exists
+            self.perm_db[act_name][tgt] = truth
+        self.queue_lock.acquire()
+        pending = self.pending_db[act_name]
+        if act_name not in self.pending_times:
+            self.pending_times[act_name] = rospy.get_time()
+        for tgt, truth in perms:
+            # Queue for learner, which also keeps track of rule performance,
+            # coalescing with any pending value for the same target
+            pending[tgt] = truth
+        self.queue_cond.notify_all()
+        self.queue_lock.release()
+        self.perm_locks[act_name].release()
+
+    def learnLoop(self, act_names):
+        """Accommodates batches of pending perms and rules until shutdown."""
+        while not rospy.is_shutdown():
+            # Wait until some permissions or rules are pending
+            self.queue_lock.acquire()
+            while (not rospy.is_shutdown() and
+                   act_names.isdisjoint(self.pending_times)):
+                self.queue_cond.wait(1.0)
+            # Take all pending permissions and rules, batched per action
+            batches = [(a, self.pending_db[a], self.pending_rules[a], t)
+                       for a, t in sorted(self.pending_times.items(),
+                                          key=lambda p : p[1])
+                       if a in act_names]
+            for a, batch, rules, t in batches:
+                self.pending_db[a] = dict()
+                self.pending_rules[a] = []
+                del self.pending_times[a]
+                self.learn_times[a] = t
+            self.queue_lock.release()
+            # Learn from each batch in order of arrival
+            for a, batch, rules, t in batches:
+                start = rospy.get_time()
+                try:
+                    # Given rules are accommodated before new permissions
+                    if len(rules) > 0:
+                        self.addRules(a, rules)
+                    if len(batch) > 0:
+                        self.learnBatch(a, batch)
+                except Exception as e:
+                    rospy.logerr("Failed to learn rules for %s: %s", a, e)
+                self.queue_lock.acquire()
+                del self.learn_times[a]
+                self.n_batches += 1
+                self.last_batch = len(batch) + len(rules)
+                self.last_duration = rospy.get_time() - start
+                self.queue_lock.release()
+
+    def learnBatch(self, act_name, batch):
+        """Accommodates a batch of new permissions for an action."""
+        # Fetch universes once for this learning step
+        universe = Universe()
+        # Only learn from perms which have targets
+        batch = dict((t, v) for t, v in batch.iteritems()
+                     if t is not objects.Nil)
+        with self.rule_locks[act_name]:
+            tally = self.tally_db[act_name]
+            tally.update(batch)
+            # Do nothing else if rule database is frozen
+            if self.freeze_rules:
+                return
+            # Check if accuracy is low enough to warrant a rule update
+            metrics = tally.metrics(self.rule_db[act_name], universe)
+            if metrics.accuracy >= self.rule_acc_thresh:
+                # Add to database of unexplained permissions
+                self.unexplained_db[act_name].update(batch)
+                self.logUnexplained(act_name, batch)
+                return
+
+        # Refresh permission targets before updating rules
+        perm_set = self.refreshTargets(act_name)
+        # Update rules to accomodate all unexplained permissions
+        with self.rule_locks[act_name]:
+            self.index_db[act_name].update(perm_set)
+            self.tally_db[act_name].update(perm_set)
+            unexplained = self.unexplained_db[act_name]
+            unexplained.update(batch)
+            for t in unexplained.keys():
+                # Use latest value, skipping perms which have been reset
+                if t in perm_set:
+                    self.accomPerm(act_name, t, perm_set[t], universe)
+            unexplained.clear()
+            self.logUnexplained(act_name)
+            self.publishRules(act_name)
+
+    def ruleInputCb(self, msg):
+        """Queues given rule for the learner to accommodate."""
         # Do nothing if rule database is frozen
         if self.freeze_rules:
-            self.perm_lock.release()
             return
 
-        # Check if accuracy is low enough to warrant a rule update
-        metrics = self.evalRuleSet(self.rule_db[action.name],
-                                   self.perm_db[action.name])
-        if metrics.accuracy < self.rule_acc_thresh:
-            # Refresh permission targets before updating rules
-            self.refreshTargets(action.name)
-            # Update rules to accomodate all unexplained permissions
-            self.rule_lock.acquire()
-            self.accomPerm(action.name, tgt, msg.truth)
-            for t, v in self.unexplained_db[action.name].iteritems():
-                self.accomPerm(action.name, t, v)
-            self.rule_lock.release()
-            self.unexplained_db[action.name].clear()
-        else:
-            # Add to database of unexplained permissions
-            self.unexplained_db[action.name][tgt] = msg.truth
-        self.perm_lock.release()
+        self.queueRules(msg.action, [(Rule.fromMsg(msg), msg.truth)])
 
-    def ruleInputCb(self, msg):
-        """Updates given rule database, adjusts active rule database."""
+    def ruleArrayInputCb(self, msg):
+        """Queues batch of given rules, grouped by action."""
         # Do nothing if rule database is frozen
         if self.freeze_rules:
             return
 
-        action = actions.db[msg.action]
-        rule = Rule.fromMsg(msg)
+        rule_db = defaultdict(list)
+        for m in msg.rules:
+            rule_db[m.action].append((Rule.fromMsg(m), m.truth))
+        for act_name, rules in rule_db.iteritems():
+            self.queueRules(act_name, rules)
 
+    def queueRules(self, act_name, rules):
+        """Queues (rule, truth) pairs given for an action for the learner."""
+        self.queue_lock.acquire()
+        if act_name not in self.pending_times:
+            self.pending_times[act_name] = rospy.get_time()
+        self.pending_rules[act_name] += rules
+        self.queue_cond.notify_all()
+        self.queue_lock.release()
+
+    def addRules(self, act_name, rules):
+        """Accommodates (rule, truth) pairs given for an action."""
+        # Do nothing if rule database is frozen
+        if self.freeze_rules:
+            return
         # Refresh permission targets before updating rules
-        self.refreshTargets(action.name)
-        # Accomdate the given rule
-        self.rule_lock.acquire()
-        self.accomRule(rule, msg.truth)
-        self.rule_lock.release()
+        perm_set = self.refreshTargets(act_name)
+        # Accomdate the given rules
+        universe = Universe()
+        self.rule_locks[act_name].acquire()
+        self.index_db[act_name].update(perm_set)
+        self.tally_db[act_name].update(perm_set)
+        for rule, truth in rules:
+            self.accomRule(rule, truth, universe)
+        self.publishRules(act_name)
+        self.rule_locks[act_name].release()
         
-    def accomPerm(self, act_name, tgt, truth):
+    def accomPerm(self, act_name, tgt, truth, universe=None):
         """Tries to accommodate the new permission by modifying rule base."""
         rule_set = self.rule_db[act_name]
-        prediction = Rule.evaluateOr(rule_set, tgt)       
+        prediction = rule_set.evaluate(tgt, universe)
 
         if truth >= self.cover_thresh and prediction < self.cover_thresh:
-            self.coverPerm(act_name, tgt, truth)
+            self.coverPerm(act_name, tgt, truth, universe)
         elif truth < self.cover_thresh and prediction >= self.cover_thresh:
-            self.uncoverPerm(act_name, tgt, truth)
+            self.uncoverPerm(act_name, tgt, truth, universe)
 
-    def coverPerm(self, act_name, tgt, truth):
+    def coverPerm(self, act_name, tgt, truth, universe=None):
         """Covers positive perm via general-to-specific search for a rule."""
         rule_set = self.rule_db[act_name]
-        perm_set = self.perm_db[act_name]
-        neg_perms = {k: v for k, v in perm_set.items()
-                     if v < self.cover_thresh}
+        index = self.index_db[act_name]
+        neg_mask = ~index.positives()
 
         # Search only for inactive rules (pointless to refine active rules) 
-        inactive_f = lambda r : r not in rule_set
+        inactive_f = InactiveFilter(rule_set)
         # Candidate rules must cover the new permission
-        cover_f = lambda r : r.evaluate(tgt) >= self.cover_thresh
+        cover_f = CoverFilter(index, tgt, universe)
         # Compute score as false positive value for each candidate rule
-        score_f = lambda r : sum([float(r.evaluate(n_tgt) >= self.cover_thresh)
-                                  for n_tgt in neg_perms.keys()])
+        score_f = RuleScore(RuleScore.covered, index, neg_mask, universe,
+                            self.score_db[act_name])
 
         # Search for rule starting with empty rule
         init_rule = Rule(actions.db[act_name], conditions=[])
         # Added rule should not cover more than a fraction of the
         # negative examples, or 1 negative example, whichever is higher
-        score_thresh = max(1.0, self.add_perm_thresh * len(neg_perms))
+        score_thresh = max(1.0, self.add_perm_thresh *
+                           np.count_nonzero(neg_mask))
         new_rule, new_score, success = \
-            self.ruleSearch(init_rule, score_thresh,
-                            score_f, [inactive_f, cover_f])
+            self.searcher.search(init_rule, score_thresh,
+                                 score_f, [inactive_f, cover_f], universe)
 
         # Add new rule if one is found
         if success:
-            self.mergeRule(rule_set, new_rule)
+            self.mergeRule(rule_set, new_rule, universe=universe)
         else:
             rospy.loginfo(("Cannot cover perm with [%s]" + 
                            "w/o too many false positives."),
                           new_rule.toPrint())
             
-    def uncoverPerm(self, act_name, tgt, truth):
+    def uncoverPerm(self, act_name, tgt, truth, universe=None):
         """Uncover negative permission by refining overly general rules."""
         rule_set = self.rule_db[act_name]
-        perm_set = self.perm_db[act_name]
-
-        # Find set of high-certainty covering rules
-        cover_rules = [r for r in rule_set if
-                       r.evaluate(tgt) >= self.cover_thresh]
+        index = self.index_db[act_name]
 
         # Candidate rules must cover negative perm
-        cover_f = lambda r : r.evaluate(tgt) >= self.cover_thresh
+        cover_f = CoverFilter(index, tgt, universe)
+
+        # Find set of high-certainty covering rules
+        cover_rules = filter(cover_f, rule_set)
 
         # Subtract minimal rule that covers new perm from each covering rule
         for init_rule in cover_rules:
-            # Find set of covered positive perms
-            pos_perms = {k: v for k, v in perm_set.items()
-                         if v >= self.cover_thresh and
-                         init_rule.evaluate(k) >= self.cover_thresh}
+            # Find mask of covered positive perms
+            pos_mask = index.positives() & index.covers(init_rule, universe)
 
             # Compute score as true positive value for each candidate rule
-            score_f = lambda r : sum([float(r.evaluate(p_tgt) >=
-                                            self.cover_thresh) for
-                                      p_tgt in pos_perms.keys()])
+            score_f = RuleScore(RuleScore.covered, index, pos_mask,
+                                universe, self.score_db[act_name])
 
             # Subtracted rule should not cover more than a fraction of the
             # positive examples, or 1 positive example, whichever is higher
-            score_thresh = max(1.0, self.sub_perm_thresh * len(pos_perms))
+            score_thresh = max(1.0, self.sub_perm_thresh *
+                               np.count_nonzero(pos_mask))
             new_rule, new_score, success = \
-                self.ruleSearch(init_rule, score_thresh, score_f, [cover_f])
+                self.searcher.search(init_rule, score_thresh, score_f,
+                                     [cover_f], universe)
             
             # Subtract found rule from covering rule
             if success:
@@ -269,26 +1443,25 @@ class RuleManager(object):
                 remainder = Rule.difference(init_rule, new_rule)
                 rule_set.discard(init_rule)
                 for new in remainder:
-                    self.mergeRule(rule_set, new)
+                    self.mergeRule(rule_set, new, universe=universe)
             else:
                 rospy.loginfo(("Cannot uncover perm from [%s]" +
                                " w/o too much false negatives."),
                               init_rule.toPrint())
 
-    def accomRule(self, given_rule, truth):
+    def accomRule(self, given_rule, truth, universe=None):
         """Tries to accommodate the given rule by modifying rule base."""
         if truth >= self.cover_thresh:
-            self.coverRule(given_rule, truth)
+            self.coverRule(given_rule, truth, universe=universe)
         else:
-            self.uncoverRule(given_rule, truth)
+            self.uncoverRule(given_rule, truth, universe=universe)
 
-    def coverRule(self, given_rule, truth, force=False):
+    def coverRule(self, given_rule, truth, force=False, universe=None):
         """Cover given positive rule if not already covered."""
         rule_set = self.rule_db[given_rule.action.name]
-        perm_set = self.perm_db[given_rule.action.name]
-        neg_perms = {k: v for k, v in perm_set.items()
-                     if v < self.cover_thresh}
-        n_neg = len(neg_perms)
+        index = self.index_db[given_rule.action.name]
+        neg_mask = ~index.positives()
+        n_neg = np.count_nonzero(neg_mask)
         
         # Do nothing if given rule is specialization of an active rule
         for r in rule_set:
@@ -296,37 +1469,38 @@ class RuleManager(object):
                 return
 
         # Score candidate rules according to false positive value 
-        score_f = lambda r : sum([max(r.evaluate(tgt) - val, 0) for
-                                  tgt, val in neg_perms.items()])
+        score_f = RuleScore(RuleScore.excess, index, neg_mask, universe,
+                            self.score_db[given_rule.action.name])
             
         # Specialize rule so that false positives are minimized
         score_thresh = self.add_rule_thresh * n_neg
         new_rule, new_score, success = \
-            self.ruleSearch(given_rule, score_thresh, score_f)
+            self.searcher.search(given_rule, score_thresh, score_f,
+                                 universe=universe)
 
         # Add specialized rule if false positive fraction is low enough
         if force or success:
-            self.mergeRule(rule_set, new_rule)
+            self.mergeRule(rule_set, new_rule, universe=universe)
         else:
             rospy.loginfo("Cannot add [%s] w/o too much over-covering.",
                           new_rule.toPrint())
         
-    def uncoverRule(self, given_rule, truth, force=False):
+    def uncoverRule(self, given_rule, truth, force=False, universe=None):
         """Uncover negative rule by refining existing rules."""
         rule_set = self.rule_db[given_rule.action.name]
-        perm_set = self.perm_db[given_rule.action.name]
-        pos_perms = {k: v for k, v in perm_set.items()
-                     if v >= self.cover_thresh} 
-        n_pos = len(pos_perms)        
+        index = self.index_db[given_rule.action.name]
+        pos_mask = index.positives()
+        n_pos = np.count_nonzero(pos_mask)
         
         # Score candidate rules according to true positive value 
-        score_f = lambda r : sum([min(r.evaluate(tgt), val) for
-                                  tgt, val in pos_perms.items()])
+        score_f = RuleScore(RuleScore.overlap, index, pos_mask, universe,
+                            self.score_db[given_rule.action.name])
 
         # Specialize rule so that true positives are minimized
         score_thresh = self.sub_perm_thresh * n_pos
         new_rule, new_score, success = \
-            self.ruleSearch(given_rule, score_thresh, score_f)
+            self.searcher.search(given_rule, score_thresh, score_f,
+                                 universe=universe)
 
         # Terminate if rule to be removed covers too many positive perms
         if not force and not success:
@@ -345,46 +1519,127 @@ class RuleManager(object):
                           new_rule.toPrint(), r.toPrint())
             rule_set.discard(r)
             for new in remainder:
-                self.mergeRule(rule_set, new)
+                self.mergeRule(rule_set, new, universe=universe)
             
-    def ruleSearch(self, init_rule, score_thresh, score_f, filters=[]):
-        """Performs general to specific search for minimal-scoring rule."""
-        best_rule, best_score = init_rule, score_f(init_rule)
-        cand_rules = [best_rule]
-        success = (all([f(init_rule) for f in filters]) and
-                   best_score <= score_thresh)
-        n_conds = len(init_rule.conditions)
-        while (len(cand_rules) > 0 and n_conds <= self.max_rule_conds):
-            # Terminate if score beats threshold
-            if success:
+    def induceRules(self, act_name, tgts, universe=None):
+        """Induces rule set covering the positive perms of the targets.
+
+        Rules are learnt by sequential covering: each rule is grown from
+        the empty rule by greedily adding the condition with the highest
+        m-estimate of precision on the uncovered positive perms, until it
+        covers few enough negative perms (c.f. coverPerm). The positive
+        perms it covers are then removed, and the next rule is grown.
+        Conditions are evaluated on all targets at once beforehand.
+        """
+        if universe is None:
+            universe = Universe()
+        index = self.index_db[act_name]
+        rule_set = RuleSet()
+        cols = np.array([index.cols[t] for t in tgts], dtype=int)
+        if len(cols) == 0:
+            return rule_set
+        conditions = Rule.groundings(universe)
+        rows = index.rows(conditions, universe, cols)
+        pos = index.values()[cols] >= self.cover_thresh
+        neg = ~pos
+        n_neg = np.count_nonzero(neg)
+        prior = np.count_nonzero(pos) / float(len(cols))
+        neg_thresh = max(1.0, self.add_perm_thresh * n_neg)
+
+        uncovered = pos.copy()
+        while np.any(uncovered):
+            # Grow rule until it covers few enough negative perms
+            lits, truth = [], np.ones(len(cols))
+            covered = np.ones(len(cols), dtype=bool)
+            while (np.count_nonzero(covered & neg) > neg_thresh and
+                   len(lits) < self.max_rule_conds):
+                best = self.bestLiteral(rows, truth, lits, uncovered,
+                                        neg, prior)
+                if best is None:
+                    break
+                k, negated = best
+                lits.append(best)
+                truth = truth * ((1-rows[k]) if negated else rows[k])
+                covered = truth >= self.cover_thresh
+            # Stop if rule no longer covers any remaining positive perms
+            if not np.any(covered & uncovered):
                 break
-            # Construct list of refinements from previous candidates
-            new_rules = [r.refine() for r in cand_rules]
-            new_rules = [r for l in new_rules for r in l]
-            n_conds += 1
-            # Select rules which match filters
-            for f in filters:
-                new_rules = filter(f, new_rules)
-            # Return if no more rules
-            if len(new_rules) == 0:
-                return best_rule, best_score, success
-            # Compute and sort by scores
-            scores = [score_f(r) for r in new_rules]
-            sort_rules = sorted(zip(new_rules, scores), key=lambda p:p[1])
-            # Select top few candidates for next round of refinement
-            cand_rules = [r for r, s in sort_rules[0:self.max_cand_rules]]
-            # Check if best candidate beats best rule
-            if len(sort_rules) > 0 and sort_rules[0][1] < best_score:
-                best_rule, best_score = sort_rules[0]
-                success = best_score <= score_thresh
-        return best_rule, best_score, success
-            
-    def mergeRule(self, rule_set, new, perm_set=None):
+            uncovered &= ~covered
+            # Discard rule if it covers too many negative perms
+            if np.count_nonzero(covered & neg) > neg_thresh:
+                continue
+            rule = Rule(actions.db[act_name],
+                        [conditions[k].negate() if negated else
+                         conditions[k] for k, negated in lits]).intern()
+            rospy.loginfo("Induced rule: [%s].", rule.toPrint())
+            rule_set.add(rule)
+        return rule_set
+
+    def bestLiteral(self, rows, truth, lits, pos, neg, prior):
+        """Returns (condition, negated) pair that best refines the truth.
+
+        Literals are ranked by m-estimate of precision on the positive
+        perms, then by number of positive perms covered. Returns None if
+        no literal covers any positive perm.
+        """
+        used = set(k for k, negated in lits)
+        best, best_key = None, None
+        for i in range(0, len(rows), Rule.block_size):
+            block = rows[i:i+Rule.block_size]
+            for negated in [False, True]:
+                refined = truth * ((1-block) if negated else block)
+                covered = refined >= self.cover_thresh
+                n_pos = (covered & pos).sum(axis=1)
+                n_neg = (covered & neg).sum(axis=1)
+                m_est = ((n_pos + self.m_param * prior) /
+                         (n_pos + n_neg + self.m_param).astype(float))
+                for j in np.lexsort((-n_pos, -m_est)):
+                    if i + j in used or n_pos[j] == 0:
+                        continue
+                    key = (m_est[j], n_pos[j])
+                    if best_key is None or key > best_key:
+                        best, best_key = (i + j, negated), key
+                    break
+        return best
+
+    def minimizeAll(self):
+        """Minimizes rule sets of all actions, returns summary."""
+        if self.freeze_rules:
+            return "Rules are frozen."
+        stats = []
+        for a in sorted(actions.db.iterkeys()):
+            stats.append("{}: {}".format(a, self.minimizeRules(a)))
+        return "\n".join(stats)
+
+    def minimizeRules(self, act_name):
+        """Replaces rule set with an equivalent minimal one.
+
+        Returns the number of rules and the time to evaluate them on all
+        permission targets, before and after minimization.
+        """
+        with self.perm_locks[act_name]:
+            tgts = [t for t in self.perm_db[act_name] if t is not objects.Nil]
+        universe = Universe()
+        with self.rule_locks[act_name]:
+            old = self.rule_db[act_name]
+            new = old.minimize()
+            # Time evaluation of fresh copies, including compilation
+            times = []
+            for rule_set in [old, new]:
+                start = time.time()
+                RuleSet(rule_set).evaluateBatch(tgts, universe)
+                times.append(time.time() - start)
+            if new != old and not self.freeze_rules:
+                self.rule_db[act_name] = new
+                self.publishRules(act_name)
+        return "rules: {} -> {} eval: {:.3f}s -> {:.3f}s".\
+            format(len(old), len(new), times[0], times[1])
+
+    def mergeRule(self, rule_set, new, universe=None):
         """Merge new rule into rule set."""
 
         rospy.loginfo("Merging new rule: [%s].", new.toPrint())
-        if perm_set == None:
-            perm_set = self.perm_db[new.action.name]
+        index = self.index_db[new.action.name]
 
         # Merge with adjacent rules (e.g. (A & B) | (A & !B) -> A)
         for r in list(rule_set):
@@ -396,8 +1651,7 @@ class RuleManager(object):
             new = merged
 
         # Compute permissions covered by new rule
-        new_cover = set([tgt for tgt, val in perm_set.items()
-                         if new.evaluate(tgt) >= self.cover_thresh])
+        new_cover = index.covers(new, universe)
                     
         # Search for generalizations or specializations after merging
         for r in list(rule_set):
@@ -412,9 +1666,10 @@ class RuleManager(object):
                 continue
             # Remove more complex rules which are covered by new one
             if len(new.conditions) <= len(r.conditions):
-                r_cover = set([tgt for tgt, val in perm_set.items()
-                               if r.evaluate(tgt) >= self.cover_thresh])
-                if r_cover < new_cover:
+                r_cover = index.covers(r, universe)
+                # Check if rule covers a proper subset of the perms
+                if (not np.any(r_cover & ~new_cover) and
+                    np.any(new_cover & ~r_cover)):
                     rospy.loginfo("Subsuming rule: [%s].", r.toPrint())
                     rule_set.remove(r)
         else:
@@ -422,31 +1677,22 @@ class RuleManager(object):
             rospy.loginfo("Adding merged rule: [%s].", new.toPrint())
             rule_set.add(new)
             
-    def evalRuleSet(self, rule_set, perm_set):
-        """Evaluates rule set and returns a performance metric tuple."""
-        guard_div = lambda x, y, z: z if (y == 0) else x/y
-        n_perms = len(perm_set)
-        n_true = sum(perm_set.values())
-        n_false = n_perms - n_true
-        tp, tn, fp, fn = 0.0, 0.0, 0.0, 0.0
-        for tgt, truth in perm_set.iteritems():
-            predict = Rule.evaluateOr(rule_set, tgt)
-            tpi, tni = min(truth, predict), min(1-truth, 1-predict)
-            fpi, fni = max(0, (1-truth)-tni), max(0, truth-tpi)
-            tp, tn = tp + tpi, tn + tni
-            fp, fn = fp + fpi, fn + fni
-        prec = guard_div(tp, (tp + fp), 1)
-        rec = guard_div(tp, (tp + fn), 1)
-        acc = guard_div((tp + tn), n_perms, 1)
-        m_est = 0 # (tp + self.m_param * n_true/n_false) / (tp + fp)
-        return RuleMetrics(tp, tn, fp, fn, prec, rec, acc, m_est)
-
     def refreshTargets(self, act_name):
-        """Refresh permission target properties for specified action."""
+        """Refreshes permission targets, returns perms which have targets."""
+        self.perm_locks[act_name].acquire()
+        tgts = self.perm_db[act_name].keys()
+        self.perm_locks[act_name].release()
+        # Look up properties without blocking permission callbacks
+        refreshed = dict(zip(tgts, objects.refreshBatch(tgts)))
+        # Keep any values which changed while refreshing
+        self.perm_locks[act_name].acquire()
         new_perms = dict()
         for tgt, val in self.perm_db[act_name].iteritems():
-            new_perms[tgt.refresh()] = val
+            new_perms[refreshed.get(tgt, tgt)] = val
         self.perm_db[act_name] = new_perms
+        self.perm_locks[act_name].release()
+        return dict((t, v) for t, v in new_perms.iteritems()
+                    if t is not objects.Nil)
     
 if __name__ == '__main__':
     rospy.init_node('rule_manager')
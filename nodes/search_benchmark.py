@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import time
+import random
+import rospy
+from collections import defaultdict
+from geometry_msgs.msg import Point
+from ownage_bot import *
+from rule_manager import RuleSearch, RuleScore, CoverFilter
+
+class SearchBenchmark(object):
+    """Compares exhaustive, serial and parallel rule search.
+
+    Searches are run directly on a fixed, seeded set of generated objects,
+    whose permissions are given by a rule set, without any other nodes.
+    """
+
+    # Search modes to compare, the first being the reference
+    modes = ["exhaustive", "serial", "parallel"]
+
+    def __init__(self):
+        # Number of trials to average over
+        self.n_trials = rospy.get_param("~n_trials", 1)
+        # Seed of the first trial, incremented for each trial
+        self.seed = rospy.get_param("~seed", 0)
+        # Number of generated permission targets and agents
+        self.n_targets = rospy.get_param("~n_targets", 500)
+        self.n_agents = rospy.get_param("~n_agents", 3)
+        # Number of searches per action and trial, 0 to search for all
+        self.n_searches = rospy.get_param("~n_searches", 0)
+        # Threshold for a rule to cover a permission target
+        self.cover_thresh = rospy.get_param("~cover_thresh", 0.5)
+
+        # Searches in each mode, with the same depth and beam width
+        max_rule_conds = rospy.get_param("~max_rule_conds", 4)
+        max_cand_rules = rospy.get_param("~max_cand_rules", 3)
+        self.search_workers = rospy.get_param("~search_workers", 4)
+        if self.search_workers <= 0:
+            raise ValueError("search_workers must be positive to compare.")
+        search_par_min = rospy.get_param("~search_par_min", 0)
+        self.searchers = {
+            "exhaustive": RuleSearch(max_rule_conds, max_cand_rules,
+                                     exhaustive=True),
+            "serial": RuleSearch(max_rule_conds, max_cand_rules),
+            "parallel": RuleSearch(max_rule_conds, max_cand_rules,
+                                   self.search_workers, search_par_min)
+        }
+
+    def loadRules(self):
+        """Loads rules from parameter server."""
+        rule_strs = rospy.get_param("~rules", [])
+        rule_msgs = [parse.cmd.asRule(s) for s in rule_strs]
+        if None in rule_msgs:
+            raise SyntaxError("Rules were in the wrong syntax")
+        rule_db = defaultdict(RuleSet)
+        for r in [Rule.fromMsg(m) for m in rule_msgs]:
+            rule_db[r.action.name].add(r)
+        return rule_db
+
+    def genTargets(self, rng, universe):
+        """Generates objects with random positions, colors and owners."""
+        colors = universe.get(Color)
+        categories = universe.get(Category)
+        owners = [None] + universe.get(Agent)
+        objs = []
+        for i in range(self.n_targets):
+            obj = Object(id=i)
+            obj.position = Point(x=rng.uniform(-1.0, 1.0),
+                                 y=rng.uniform(-1.0, 1.0), z=0.0)
+            if len(colors) > 0:
+                obj.color = rng.choice(colors).name
+            if len(categories) > 0:
+                obj.categories[rng.choice(categories)] = 1.0
+            owner = rng.choice(owners)
+            if owner is not None:
+                obj.ownership[owner.id] = 1.0
+            objs.append(obj)
+        return objs
+
+    def search(self, mode, act_name, index, tgt, universe):
+        """Searches for a rule which covers the target (c.f. coverPerm)."""
+        cover_f = CoverFilter(index, tgt, universe)
+        score_f = RuleScore(RuleScore.covered, index,
+                            ~index.positives(), universe)
+        init_rule = Rule(actions.db[act_name])
+        start = time.time()
+        new_rule, new_score, success = \
+            self.searchers[mode].search(init_rule, 0.0, score_f,
+                                        [cover_f], universe)
+        return new_rule, new_score, time.time() - start
+
+    def run(self):
+        """Runs searches for positive permissions of every action."""
+        Object.use_inferred = False
+        rule_db = self.loadRules()
+        agents = [Agent(id=i+1) for i in range(self.n_agents)]
+        results = defaultdict(lambda : defaultdict(float))
+        for i in range(self.n_trials):
+            print "-- Trial {} --".format(i+1)
+            rng = random.Random(self.seed + i)
+            universe = Universe({Agent: agents})
+            objs = self.genTargets(rng, universe)
+            for act_name, rule_set in sorted(rule_db.iteritems()):
+                index = CoverageIndex(self.cover_thresh)
+                perms = rule_set.evaluateBatch(objs, universe)
+                index.update(dict(zip(objs, perms)))
+                # Evaluate all conditions before timing any search
+                index.rows(Rule.groundings(universe), universe)
+                # Search for rules which cover positive perms
+                tgts = [o for o, v in zip(objs, perms)
+                        if v >= self.cover_thresh]
+                if self.n_searches > 0 and len(tgts) > self.n_searches:
+                    tgts = rng.sample(tgts, self.n_searches)
+                found = dict((m, []) for m in self.modes)
+                for tgt in tgts:
+                    for m in self.modes:
+                        rule, score, duration = \
+                            self.search(m, act_name, index, tgt, universe)
+                        found[m].append((rule, score))
+                        results[act_name][m] += duration
+                results[act_name]["searches"] += len(tgts)
+                # Count searches which differ from the reference mode
+                ref = found[self.modes[0]]
+                for m in self.modes[1:]:
+                    results[act_name]["mismatches"] += \
+                        sum(a != b for a, b in zip(ref, found[m]))
+                results[act_name]["rules"] += len(set(r for r, s in ref))
+
+        # Print total times and speedups over exhaustive search
+        headers = (["searches", "rules"] + self.modes +
+                   ["x_ser", "x_par", "mismatches"])
+        print "== Rule search with {} workers, {} targets ==".\
+            format(self.search_workers, self.n_targets)
+        print "\t".join(["action"] + [h[:5] for h in headers])
+        for act_name, r in sorted(results.iteritems()):
+            r["x_ser"] = r["exhaustive"] / max(r["serial"], 1e-9)
+            r["x_par"] = r["exhaustive"] / max(r["parallel"], 1e-9)
+            print "\t".join([act_name] + [str(r[k])[:5] for k in headers])
+
+        # All modes should find exactly the same rules
+        n_mismatches = sum(r["mismatches"] for r in results.itervalues())
+        if n_mismatches > 0:
+            raise AssertionError("{} searches found different rules.".\
+                                 format(int(n_mismatches)))
+
+if __name__ == '__main__':
+    rospy.init_node('search_benchmark')
+    search_benchmark = SearchBenchmark()
+    search_benchmark.run()
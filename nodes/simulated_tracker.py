@@ -47,6 +47,8 @@ class SimulatedTracker(OwnershipTracker):
                 obj.color = new.color
                 obj.categories = dict(new.categories)
                 obj.t_last_actions = dict(new.t_last_actions)
+                # Update stored percepts in place
+                self.updatePercepts(obj.id)
 
 if __name__ == '__main__':
     rospy.init_node('object_tracker')
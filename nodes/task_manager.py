@@ -57,7 +57,8 @@ class TaskManager(object):
         self.listObjects = rospy.ServiceProxy("list_objects", ListObjects)
         self.lookupObject = rospy.ServiceProxy("lookup_object", LookupObject)
         self.lookupPerm = rospy.ServiceProxy("lookup_perm", LookupPerm)
-        self.lookupRules = rospy.ServiceProxy("lookup_rules", LookupRules)
+        # Cache of active rules, kept current by the rule manager
+        self.rule_cache = RuleCache()
 
         # Servers that handle lookup requests
         self.cur_tsk_srv = rospy.Service("cur_task", Trigger,
@@ -161,26 +162,27 @@ class TaskManager(object):
 
     def checkRules(self, action, tgt, violations=[]):
         """Returns true if rules forbid action on target."""
+        # Fetch universes once per decision
+        universe = Universe()
         for a in (action.dependencies + [action]):
             try:
-                rule_set = self.lookupRules(a.name).rule_set
-                rospy.sleep(0.02)
+                rule_set = self.rule_cache.get(a.name)
             except rospy.ServiceException:
                 # Fail silently and assume allowed
                 rospy.logwarn("Could not lookup rules")
                 continue                
-            rule_set = [Rule.fromMsg(r) for r in rule_set]
             # Check target types
             if a.tgtype == type(tgt):
-                truth = Rule.evaluateOr(rule_set, tgt)
+                truth = rule_set.evaluate(tgt, universe)
             elif a.tgtype == type(None):
-                truth = Rule.evaluateOr(rule_set, None)
+                truth = rule_set.evaluate(None)
             else:
                 continue
             if truth >= self.decision_thresh:
                 # Return list of rules violated through optional argument
                 violations += sorted(rule_set, reverse=True,
-                                     key=lambda r : r.evaluate(tgt))
+                                     key=lambda r : r.evaluate(
+                                         tgt, universe=universe))
                 return True
         return False
     
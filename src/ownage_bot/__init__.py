@@ -7,7 +7,8 @@ from . import context
 from . import parse
 
 from .objects import Object, Agent, Area, Location, Category, Color
+from .objects import Universe
 from .actions import Action
 from .predicates import Predicate
-from .rules import Rule
+from .rules import Rule, RuleSet, CoverageIndex, RuleCache
 from .tasks import Task
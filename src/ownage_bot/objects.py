@@ -2,6 +2,7 @@ import math
 import copy
 import rospy
 import time
+import itertools
 import numpy as np
 import matplotlib.path as mplPath
 from ownage_bot.msg import *
@@ -44,6 +45,36 @@ Any = Constant("any")
 
 # Constant that represents empty / unbound argument
 Nil = Constant("nil")
+
+# Process-wide counter from which object versions are drawn
+_versions = itertools.count(1)
+
+class Universe(object):
+    """Snapshot of the universe of each argument type.
+
+    Each universe is fetched at most once per snapshot, so a snapshot can
+    be passed down through an evaluation or learning step to avoid
+    repeated service calls and parameter lookups. Universes of some
+    argtypes can also be fixed in advance, e.g. to evaluate offline.
+    """
+    def __init__(self, fixed=dict()):
+        self._universes = dict(fixed)
+        # Values derived from the snapshot (e.g. grounded predicates)
+        self.derived = dict()
+
+    def get(self, argtype):
+        """Returns snapshot of argtype's universe (should not be modified)."""
+        if argtype not in self._universes:
+            self._universes[argtype] = list(argtype.universe())
+        return self._universes[argtype]
+
+    def key(self, argtype):
+        """Returns hashable key which changes with argtype's universe."""
+        k = ("key", argtype)
+        if k not in self.derived:
+            self.derived[k] = tuple((a.toStr(), getattr(a, "version", None))
+                                    for a in self.get(argtype))
+        return self.derived[k]
         
 class Object(object):
     """Represents objects in the workspace and their properties."""
@@ -56,6 +87,10 @@ class Object(object):
 
     # Flag whether or not to use inferred ownership probabilities
     use_inferred = True
+
+    # Properties which predicates depend on, version changes when set
+    versioned = frozenset(["position", "color", "categories",
+                           "ownership", "inferred"])
     
     any_str = "something"
     nil_str = "it"
@@ -64,19 +99,22 @@ class Object(object):
                  position=Point(), orientation=Quaternion(),
                  speed=0.0, color="none", is_avatar=False,
                  owners=[], categories=[]):
-        self.id = id
-        self.name = name
-        self.t_last_update = rospy.Time()
-        self.position = position
-        self.orientation = orientation
-        self.speed = speed
-        self.proximities = [] # List of distances to avatars
-        self.color = color # Name of color
-        self.ownership = dict() # Dictionary of ownership probabilities
-        self.inferred = dict() # Dictionary of inferred ownership probs
-        self.categories = dict() # Dictionary of category membership
-        self.t_last_actions = dict() # Dictionary of last action times
-        self.is_avatar = is_avatar # Whether object is an avatar
+        # Set properties directly so that only one version is drawn
+        d = self.__dict__
+        d["version"] = next(_versions) # Changes whenever properties do
+        d["id"] = id
+        d["name"] = name
+        d["t_last_update"] = rospy.Time()
+        d["position"] = position
+        d["orientation"] = orientation
+        d["speed"] = speed
+        d["proximities"] = [] # List of distances to avatars
+        d["color"] = color # Name of color
+        d["ownership"] = dict() # Dictionary of ownership probabilities
+        d["inferred"] = dict() # Dictionary of inferred ownership probs
+        d["categories"] = dict() # Dictionary of category membership
+        d["t_last_actions"] = dict() # Dictionary of last action times
+        d["is_avatar"] = is_avatar # Whether object is an avatar
         for o in owners:
             self.ownership[o] = 1.0
         for c in categories:
@@ -97,6 +135,23 @@ class Object(object):
         """Hash only the ID."""
         return hash(self.id)
 
+    def __setattr__(self, name, value):
+        """Draws a new version when a versioned property is set."""
+        object.__setattr__(self, name, value)
+        if name in self.versioned:
+            object.__setattr__(self, "version", next(_versions))
+
+    def touch(self):
+        """Draws a new version after properties are modified in place."""
+        self.version = next(_versions)
+
+    def keepVersion(self, old):
+        """Reuses version of an older copy if properties are unchanged."""
+        if old.id != self.id or old.version == self.version:
+            return
+        if all(getattr(self, p) == getattr(old, p) for p in self.versioned):
+            self.__dict__["version"] = old.version
+
     def refresh(self):
         """Returns refresh copy of the object by looking up the database."""
         cls = self.__class__
@@ -105,8 +160,9 @@ class Object(object):
     def copy(self):
         """Makes a copy of the Object."""
         obj = self.__class__()
+        # Copy directly so that the copy shares the same version
         for k, v in self.__dict__.items():
-            setattr(obj, k, copy.deepcopy(v))
+            obj.__dict__[k] = copy.deepcopy(v)
         return obj
 
     def getOwnership(self, agent_id):
@@ -119,7 +175,7 @@ class Object(object):
     def toMsg(self):
         """Converts Object to a ROS message."""
         msg = ObjectMsg()
-        uncopyable = ["ownership", "categories", "t_last_actions"] 
+        uncopyable = ["ownership", "categories", "t_last_actions", "version"]
         for k, v in self.__dict__.items():
             if k in uncopyable:
                 continue
@@ -226,13 +282,29 @@ class Object(object):
                 rospy.wait_for_service("list_objects",
                                        timeout=cls._cache_latency.to_sec())
                 resp = cls._listObjects()
-                cls._universe_cache =  set(cls.fromMsg(m) for m in
-                                           resp.objects)
+                cls._universe_cache = cls._refreshCache(resp.objects)
                 cls._last_cache_time = rospy.Time.now()
             except:
                 # Just return cache if service call could not be executed
                 rospy.logwarn("Service error, returning cache instead...")
         return sorted(cls._universe_cache, key = lambda x : x.id)
+
+    @classmethod
+    def _refreshCache(cls, msgs, prev=[]):
+        """Builds new universe cache, keeping versions of unchanged Objects.
+
+        Previous copies are looked up in the old cache, and then in prev,
+        so that caches keyed by version are only invalidated by changes.
+        """
+        old = dict((o.id, o) for o in cls._universe_cache)
+        old.update((o.id, o) for o in prev)
+        fresh = set()
+        for m in msgs:
+            obj = cls.fromMsg(m)
+            if obj.id in old:
+                obj.keepVersion(old[obj.id])
+            fresh.add(obj)
+        return fresh
     
 class Agent(object):
     """Represents an agent that can own and act on objects."""
@@ -335,6 +407,11 @@ class Agent(object):
 class Area(object):
     """Defines a 2D polygonal area."""
 
+    # Latest definition of each named area, as last read from params
+    _defined = dict()
+    # Incremented whenever a named area is (re)defined
+    revision = 0
+
     any_str = "some"
     nil_str = "there"
     
@@ -364,6 +441,12 @@ class Area(object):
         """Minimal string representation."""
         return str(self.points)
 
+    def current(self):
+        """Returns the latest definition of the area with this name."""
+        if self.name == "":
+            return self
+        return self._defined.get(self.name, self)
+
     def toPrint(self):
         """Human-readable string."""
         if self.name != "":
@@ -386,8 +469,9 @@ class Area(object):
             pass
         # Try looking up in database
         areas = rospy.get_param("areas", dict())
-        for k, v in areas.iteritems():
-            a = cls(v["corners"], name=k)
+        areas = [cls(v["corners"], name=k) for k, v in areas.iteritems()]
+        cls._define(areas)
+        for a in areas:
             if (new == None and s == a.name) or (new == a):
                 return a
         if new != None:
@@ -399,7 +483,17 @@ class Area(object):
         """Returns a sorted list of all Areas (defined in param server)."""
         areas = rospy.get_param("areas", dict())
         l = [cls(v["corners"], name=k) for k, v in areas.iteritems()]
+        cls._define(l)
         return sorted(l, key = lambda x : x.toStr())
+
+    @classmethod
+    def _define(cls, areas):
+        """Records the latest definitions of named areas."""
+        for a in areas:
+            old = cls._defined.get(a.name)
+            if old is None or old.points != a.points:
+                cls._defined[a.name] = a
+                cls.revision += 1
     
 class Location(object):
     """Defines a location in space."""
@@ -541,3 +635,44 @@ def dist(p1, p2):
 def inArea(obj, area):
     """Checks if object is located in area."""
     return bool(area.path.contains_point((obj.position.x, obj.position.y)))
+
+def inAreaBatch(objs, area):
+    """Checks which of a list of objects are located in area."""
+    if len(objs) == 0:
+        return np.zeros(0, dtype=bool)
+    points = np.array([(o.position.x, o.position.y) for o in objs])
+    return area.path.contains_points(points)
+
+def refreshBatch(tgts, fallback=True):
+    """Returns refreshed copies of targets, listing Objects only once.
+
+    If listing fails, targets are looked up one by one if fallback is
+    set, and are otherwise returned as they are.
+    """
+    objs = [t for t in tgts if isinstance(t, Object)]
+    if len(objs) == 0:
+        return [t.refresh() for t in tgts]
+    try:
+        resp = Object._listObjects()
+    except:
+        if not fallback:
+            rospy.logwarn("Service error, targets were not refreshed...")
+            return list(tgts)
+        # Fall back to looking up each target if listing fails
+        rospy.logwarn("Service error, refreshing targets one by one...")
+        return [t.refresh() for t in tgts]
+    # Replicate listing in the universe cache as well
+    fresh = Object._refreshCache(resp.objects, objs)
+    Object._universe_cache = fresh
+    Object._last_cache_time = rospy.Time.now()
+    fresh = dict((o.id, o) for o in fresh)
+    new = []
+    for t in tgts:
+        if not isinstance(t, Object):
+            new.append(t.refresh())
+        elif t.id in fresh:
+            new.append(fresh[t.id])
+        else:
+            # Object is no longer listed, so look it up directly
+            new.append(t.refresh())
+    return new
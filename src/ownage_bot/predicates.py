@@ -1,11 +1,77 @@
 import os
 import rospy
 import copy
+import threading
+import weakref
+import numpy as np
+from collections import OrderedDict
 from ownage_bot.msg import *
 from .objects import *
 
+class TruthCache(object):
+    """Bounded LRU cache of predicate truth values on versioned objects.
+
+    Entries are keyed by predicate, object ID, object version and area
+    revision, so they are never stale as long as objects are modified
+    through attribute assignment or followed by Object.touch(). Changes to
+    the universe of an Any argument are not tracked, so clear() should be
+    called then.
+    """
+
+    def __init__(self, max_size=10000):
+        self.enabled = True
+        self.max_size = max_size # Maximum number of entries
+        self.hits = 0 # Number of successful lookups
+        self.misses = 0 # Number of failed lookups
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns cached value (refreshing its recency), or None."""
+        with self._lock:
+            val = self._entries.pop(key, None)
+            if val is None:
+                self.misses += 1
+                return None
+            self._entries[key] = val
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        """Stores value, evicting the least recently used if full."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = val
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries and resets counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.misses = 0, 0
+
+    def stats(self):
+        """Returns string summary of cache size and hit rate."""
+        n_lookups = self.hits + self.misses
+        rate = 0.0 if n_lookups == 0 else float(self.hits) / n_lookups
+        return "size={} hits={} misses={} hit_rate={:.3f}".\
+            format(len(self._entries), self.hits, self.misses, rate)
+
+# Cache shared by all predicates
+cache = TruthCache()
+
+# Canonical instances of predicates, keyed by name, negation and bindings
+_interned = weakref.WeakValueDictionary()
+_intern_lock = threading.Lock()
+
 class Predicate(object):
-    """Functional representation of object properties and relations."""
+    """Functional representation of object properties and relations.
+
+    Predicates returned by bind, negate and simplify are interned, i.e.
+    each distinct predicate exists once with a precomputed hash, and
+    should not be modified. Use copy to get a modifiable predicate.
+    """
     
     def __init__(self, name="", argtypes=[], speech_fmt=""):
         self.name = name # Human-readable name
@@ -15,14 +81,23 @@ class Predicate(object):
         self.negated = False # Whether predicate is negated
         self.bindings = [Nil] * self.n_args  # All arguments intially free
         self._apply = lambda *args : True # Implementation of predicate
+        self._applyBatch = None # Optional vectorized implementation
         self.speech_fmt = speech_fmt # Format for speech output
+        self._hash = None # Hash, precomputed once interned
+        self._ident = None # Identifying key, stored once interned
+        self._negation = None # Interned negation, once computed
 
     def __eq__(self, other):
         """Check for equality of name, argtypes, bindings and negation."""
+        if self is other:
+            return True
         if isinstance(other, self.__class__):
+            if (self._hash is not None and other._hash is not None and
+                self._hash != other._hash):
+                return False
             return (self.name == other.name and
                     self.argtypes == other.argtypes and
-                    self.bindings == other.bindings and
+                    self._bindKeys() == other._bindKeys() and
                     self.negated == other.negated)
             return True
         return NotImplemented
@@ -34,12 +109,52 @@ class Predicate(object):
     
     def __hash__(self):
         """Hash using name, bindings, and negation."""
-        return hash((self.name, self.negated, self._bindStrs()))
+        if self._hash is not None:
+            return self._hash
+        return hash(self._key())
+
+    def _key(self):
+        """Returns tuple which identifies the predicate."""
+        if self._ident is not None:
+            return self._ident
+        return (self.name, self.negated, self._bindKeys())
+
+    def intern(self):
+        """Returns the canonical instance of an equal predicate.
+
+        The first predicate interned with a given key becomes canonical,
+        so bound objects should only be relied upon for their identity
+        (e.g. named areas are evaluated with their latest definition).
+        """
+        if self._hash is not None:
+            return self
+        key = self._key()
+        with _intern_lock:
+            canon = _interned.get(key)
+            if canon is None:
+                self._hash = hash(key)
+                self._ident = key
+                _interned[key] = self
+                canon = self
+        return canon
+
+    def _bindKeys(self):
+        """Convert bindings to tuple of identifying strings.
+
+        Named areas are identified by name rather than vertices, since
+        they are evaluated with their latest definition.
+        """
+        key = lambda a : (a.name if isinstance(a, Area) and a.name != ""
+                          else a.toStr())
+        return tuple(key(b) if type(b) is not list else
+                     "|" + "|".join([key(a) for a in b]) + "|"
+                     for b in self.bindings)
 
     def _bindStrs(self):
-        """Convert bindings to tuple of strings."""
-        return tuple(b.toStr() if type(b) is not list else
-                     "|" + "|".join([a.toStr() for a in b]) + "|"
+        """Convert bindings to tuple of strings, using current areas."""
+        s = lambda a : (a.current() if isinstance(a, Area) else a).toStr()
+        return tuple(s(b) if type(b) is not list else
+                     "|" + "|".join([s(a) for a in b]) + "|"
                      for b in self.bindings)
 
     def copy(self):
@@ -48,6 +163,7 @@ class Predicate(object):
         cp.exc_arg = self.exc_arg
         cp.bindings = list(self.bindings)
         cp._apply = self._apply
+        cp._applyBatch = self._applyBatch
         cp.negated = self.negated
         cp.speech_fmt = self.speech_fmt
         return cp
@@ -80,12 +196,19 @@ class Predicate(object):
             else:
                 bound.bindings[i] = a                
 
-        return bound
+        return bound.intern()
 
     def negate(self):
-        """Returns negated copy of self."""
+        """Returns interned negation of self."""
+        if self._negation is not None:
+            return self._negation
         negation = self.copy()
         negation.negated = not self.negated
+        negation = negation.intern()
+        # Only interned predicates are immutable, so only cache for those
+        if self._hash is not None:
+            self._negation = negation
+            negation._negation = self
         return negation
 
     def generalize(self):
@@ -97,7 +220,7 @@ class Predicate(object):
             generalized.bindings[i] = Any
         return generalized
     
-    def simplify(self):
+    def simplify(self, universe=None):
         """Simplifies disjunct arguments.
 
         Example (assuming there are only 3 agents):
@@ -113,24 +236,43 @@ class Predicate(object):
             argtype = simple.argtypes[i]
             if type(arg) is not list:
                 continue
-            universe = argtype.universe()
+            atoms = list(argtype.universe() if universe is None
+                         else universe.get(argtype))
             # Replace with Any if all possibilities are present
-            if len(arg) == len(universe) and arg == universe:
+            if len(arg) == len(atoms) and arg == atoms:
                 simple.bindings[i] = Any
                 continue
             # Replace with negation of shorter list if exclusivity holds
-            if self.exc_arg == i and len(arg) > len(universe)/2:
+            if self.exc_arg == i and len(arg) > len(atoms)/2:
                 for a in arg:
-                    universe.remove(a)
-                if len(universe) == 1:
-                    universe = universe[0]
-                simple.bindings[i] = universe
+                    atoms.remove(a)
+                if len(atoms) == 1:
+                    atoms = atoms[0]
+                simple.bindings[i] = atoms
                 simple.negated = not simple.negated
 
-        return simple
+        return simple.intern()
     
-    def apply(self, *args):
-        """Applies implementation with bindings and negation."""
+    def apply(self, *args, **kwargs):
+        """Applies implementation with bindings and negation.
+
+        universe -- optional Universe snapshot used to expand Any
+        """
+        universe = kwargs.get("universe", None)
+        # Look up cached value if the only argument is an Object
+        if (not cache.enabled or len(args) != 1 or
+            not isinstance(args[0], Object)):
+            return self._applyUncached(args, universe)
+        key = (self, args[0].id, args[0].version, Object.use_inferred,
+               Area.revision)
+        val = cache.get(key)
+        if val is None:
+            val = self._applyUncached(args, universe)
+            cache.put(key, val)
+        return val
+
+    def _applyUncached(self, args, universe=None):
+        """Applies implementation without looking up the cache."""
 
         # Substitute arguments into Nil slots
         args = list(reversed(args))
@@ -145,7 +287,9 @@ class Predicate(object):
         for i in range(self.n_args):
             argtype = self.argtypes[i]
             if all_args[i] == Any:
-                all_args[i] = argtype.universe() # Replace Any with universe
+                # Replace Any with universe
+                all_args[i] = (argtype.universe() if universe is None
+                               else universe.get(argtype))
                 multi_arg_pos.append(i)
                 continue
             if type(all_args[i]) in [list, tuple]:
@@ -184,6 +328,45 @@ class Predicate(object):
                 break
         return neg_val if self.negated else 1-neg_val
 
+    def applyBatch(self, args, universe=None):
+        """Applies predicate to each of a list of arguments at once.
+
+        Each argument is substituted into the only Nil slot, and an array
+        of truth values (one per argument) is returned.
+        """
+        nil_pos = [i for i, b in enumerate(self.bindings) if b == Nil]
+        if len(nil_pos) != 1:
+            raise ValueError("Wrong number of arguments.")
+        pos = nil_pos[0]
+        for a in args:
+            if not isinstance(a, self.argtypes[pos]):
+                raise TypeError("Argument is the wrong type.")
+
+        # Expand Any and internal lists in the bound slots
+        cur_stack = [list(self.bindings)]
+        for i, b in enumerate(self.bindings):
+            if b == Any:
+                atoms = (self.argtypes[i].universe() if universe is None
+                         else universe.get(self.argtypes[i]))
+            elif type(b) in [list, tuple]:
+                atoms = b
+            else:
+                continue
+            cur_stack = [s[:i] + [a] + s[i+1:] for s in cur_stack
+                         for a in atoms]
+
+        # Evaluate all substitutions, combine using noisy or
+        neg_vals = np.ones(len(args))
+        for cur_args in cur_stack:
+            if self._applyBatch is not None:
+                vals = self._applyBatch(*(cur_args[:pos] + [args] +
+                                          cur_args[pos+1:]))
+            else:
+                vals = [self._apply(*(cur_args[:pos] + [a] +
+                                      cur_args[pos+1:])) for a in args]
+            neg_vals *= 1 - np.asarray(vals, dtype=float)
+        return neg_vals if self.negated else 1-neg_vals
+
     def query(self):
         """Return entities which make predicate true."""
         # TODO: Currently this only works to query one argument
@@ -246,8 +429,9 @@ class Predicate(object):
             else:
                 # Directly convert from string to argtype
                 bindings.append(t.fromStr(s))
-        p = p.bind(bindings) # This creates a new Predicate object
-        p.negated = msg.negated # Which can safely be modified
+        p = p.bind(bindings) # This returns an interned Predicate object
+        if p.negated != msg.negated: # Which should not be modified
+            p = p.negate()
         return p
     
 # List of pre-defined predicates
@@ -256,16 +440,23 @@ Near._apply = lambda o1, o2: dist(o1.position, obj2.position) < 0.4
 
 OwnedBy = Predicate("ownedBy", [Object, Agent], "{0} is {n}owned by {1}")
 OwnedBy._apply = (lambda obj, agent: obj.getOwnership(agent.id))
+OwnedBy._applyBatch = (lambda objs, agent:
+                       [o.getOwnership(agent.id) for o in objs])
 
 InArea = Predicate("inArea", [Object, Area], "{0} is {n}in {1} area")
-InArea._apply = lambda obj, area: inArea(obj, area)
+InArea._apply = lambda obj, area: inArea(obj, area.current())
+InArea._applyBatch = lambda objs, area: inAreaBatch(objs, area.current())
 
 InCategory = Predicate("inCategory", [Object, Category], "{0} is {n}{1}")
 InCategory._apply = lambda obj, c: (0.0 if c not in obj.categories else
                                     obj.categories[c])
+InCategory._applyBatch = lambda objs, c: [o.categories.get(c, 0.0)
+                                          for o in objs]
 
 IsColored = Predicate("isColored", [Object, Color], "{0} is {n}colored {1}")
 IsColored._apply = lambda obj, col: float(obj.color == col.name)
+IsColored._applyBatch = (lambda objs, col:
+                         np.array([o.color for o in objs]) == col.name)
 IsColored.exc_arg = 1 # Colors are exclusive categories
 
 # List of available predicates for each robotic platform
@@ -274,4 +465,10 @@ if os.getenv("OWNAGE_BOT_PLATFORM", "baxter") == "baxter":
     db = [OwnedBy, InArea, InCategory, IsColored]
 else:
     db = []
-db = dict([(p.name, p) for p in db])
+db = dict([(p.name, p.intern()) for p in db])
+
+def truthMatrix(preds, args, universe=None):
+    """Returns (arguments x predicates) array of truth values."""
+    if len(preds) == 0:
+        return np.zeros((len(args), 0))
+    return np.column_stack([p.applyBatch(args, universe) for p in preds])
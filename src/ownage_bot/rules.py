@@ -1,28 +1,53 @@
 import rospy
+import threading
+import weakref
+import numpy as np
+from std_srvs.srv import Trigger, TriggerResponse
 from ownage_bot.msg import *
+from ownage_bot.srv import *
 from . import objects
 from . import predicates
 from . import actions
 
+# Canonical instances of rules, keyed by action name, conditions and detype
+_interned = weakref.WeakValueDictionary()
+_intern_lock = threading.Lock()
+
 class Rule(object):
-    """Condition-action pairs that the robot should follow."""    
+    """Condition-action pairs that the robot should follow.
+
+    Rules are immutable, and their conditions are frozensets of interned
+    predicates. Rules returned by refine, refineRelevant, difference,
+    intersect and merge are interned as well.
+    """    
     
     # Constants defining rule types
     forbidden = "forbid"
     allowed = "allow"
+
+    # Number of conditions to evaluate at once in refineRelevant
+    block_size = 64
     
     def __init__(self, action=actions.Empty, conditions=[],
                  detype="forbid"):
         # Action to be performed
         self.action = action
         # Set of predicates that have to be true for the rule to follow
-        self.conditions = set(conditions)
+        self.conditions = frozenset(p.intern() for p in conditions)
         # Deontic operator type
         self.detype = detype
+        # Precompute hash since rules are immutable
+        self._hash = hash(self._key())
+        # Whether this is the canonical instance
+        self._interned = False
 
     def __eq__(self, other):
         """Rules are equal if their conditions, actions and types are."""
+        if self is other:
+            return True
         if isinstance(other, self.__class__):
+            if self._hash != other._hash:
+                return False
             return (self.action.name == other.action.name and
                     self.conditions == other.conditions and
                     self.detype == other.detype)
@@ -35,9 +60,26 @@ class Rule(object):
 
     def __hash__(self):
         """Hash using action name, condition hash and detype."""
-        return hash((self.action.name, tuple(self.conditions), self.detype))
+        return self._hash
+
+    def _key(self):
+        """Returns tuple which identifies the rule."""
+        return (self.action.name, self.conditions, self.detype)
+
+    def intern(self):
+        """Returns the canonical instance of an equal rule."""
+        if self._interned:
+            return self
+        key = self._key()
+        with _intern_lock:
+            canon = _interned.get(key)
+            if canon is None:
+                self._interned = True
+                _interned[key] = self
+                canon = self
+        return canon
         
-    def evaluate(self, tgt, exclusions=set()):
+    def evaluate(self, tgt, exclusions=set(), universe=None):
         """Evaluates if target satisfies the predicates."""
         truth = 1.0
         # Check that target type is correct, or return true if None
@@ -48,7 +90,7 @@ class Rule(object):
         # Iterate through all non-excluded predicates
         for p in self.conditions:
             if p not in exclusions:
-                truth *= p.apply(tgt)
+                truth *= p.apply(tgt, universe=universe)
         return truth
 
     @classmethod
@@ -70,7 +112,7 @@ class Rule(object):
         return truth
 
     @classmethod
-    def evaluateOr(cls, rule_set, tgt, exclusions=set()):
+    def evaluateOr(cls, rule_set, tgt, exclusions=set(), universe=None):
         """Evaluates probabilistic disjunction of rules."""
         # Assume false if no rules
         if len(rule_set) == 0:
@@ -79,7 +121,7 @@ class Rule(object):
         # Calculate truth probability of the first rule
         rule_set = set(rule_set)
         cur = rule_set.pop()
-        truth = cur.evaluate(tgt, exclusions)
+        truth = cur.evaluate(tgt, exclusions, universe)
 
         # Bottom out if only one rule
         if len(rule_set) == 0:
@@ -93,8 +135,10 @@ class Rule(object):
         p_conj_probs = [1.0] # e.g. [1.0, P(A), P(A*B), P(A*B*C)]
         p_remainders = [] # Remainder rule sets for each part
         for i, p in enumerate(conditions):
-            p_prob = p.apply(tgt)
-            p_parts.append(conditions[0:i-1] + [p.negate()])
+            # Excluded predicates are already known to be true
+            p_prob = (1.0 if p in exclusions else
+                      p.apply(tgt, universe=universe))
+            p_parts.append(conditions[0:i] + [p.negate()])
             p_part_probs.append((1-p_prob) * p_conj_probs[-1])
             p_conj_probs.append(p_prob * p_conj_probs[-1])
             p_remainders.append(set(rule_set))
@@ -109,13 +153,19 @@ class Rule(object):
         for prob, part, remainder in zip(p_part_probs, p_parts, p_remainders):
             # Exclude potentially identical predicates (idempotency)
             truth += prob * cls.evaluateOr(remainder, tgt,
-                                           exclusions.union(part))
+                                           exclusions.union(part), universe)
                     
         return truth
 
-    def refine(self):
-        """Return list of refinements by adding predicates to rule."""
-        refinements = []
+    @classmethod
+    def groundings(cls, universe):
+        """Returns list of predicates that refinements can add.
+
+        The list is computed once per universe snapshot, and should not be
+        modified.
+        """
+        if "groundings" in universe.derived:
+            return universe.derived["groundings"]
         conditions = list(predicates.db.values())
 
         # Exhaustively substitute all non-1st-place arguments
@@ -125,7 +175,7 @@ class Rule(object):
             cur_stack, new_stack = [p], []
             for i in range(1, p.n_args):
                 # List 'Any' first because it's the most general
-                atoms = [objects.Any] + p.argtypes[i].universe()
+                atoms = [objects.Any] + universe.get(p.argtypes[i])
                 for q in cur_stack:
                     bound = [q.bind(q.bindings[0:i] + [a] + q.bindings[i+1:])
                              for a in atoms]
@@ -134,17 +184,79 @@ class Rule(object):
                 new_stack = []
             conditions.remove(p)
             conditions += cur_stack
+
+        universe.derived["groundings"] = conditions
+        return conditions
+
+    def refine(self, universe=None):
+        """Return list of refinements by adding predicates to rule."""
+        if universe is None:
+            universe = objects.Universe()
+        refinements = []
+        conditions = self.groundings(universe)
                 
         for p in conditions:
             # Check for idempotency / complementation
             if p in self.conditions or p.negate() in self.conditions:
                 continue
-            n1 = self.__class__(self.action, self.conditions, self.detype)
-            n2 = self.__class__(self.action, self.conditions, self.detype)
-            n1.conditions.add(p)
-            n2.conditions.add(p.negate())            
+            n1 = self.__class__(self.action, self.conditions | set([p]),
+                                self.detype).intern()
+            n2 = self.__class__(self.action,
+                                self.conditions | set([p.negate()]),
+                                self.detype).intern()
             refinements += [n1, n2]
         return refinements
+
+    def refineRelevant(self, index, bound_f=None, universe=None):
+        """Lazily generates refinements which split the covered targets.
+
+        Conditions which are all true or all false on the targets of the
+        coverage index that this rule covers are skipped, since adding
+        them (or their negations) either changes nothing or leaves no
+        target covered. Refinements are generated as (bound, position,
+        rule) tuples, where position orders them as in refine. If bound_f
+        is given, it should map the truth of this rule, a (conditions x
+        columns) array of condition truths and the target columns to lower
+        bounds on the scores of refinements by each condition, followed by
+        those by their negations. Refinements are then generated in
+        ascending order of their bounds, and only constructed on request.
+        """
+        if universe is None:
+            universe = objects.Universe()
+        conditions = self.groundings(universe)
+        truth = index.truth(self, universe)
+        cols = np.flatnonzero(truth > 0)
+        truth = truth[cols]
+
+        # Find relevant conditions and bound their refinements in blocks
+        entries = []
+        for i in range(0, len(conditions), self.block_size):
+            block = [k for k in range(i, min(i + self.block_size,
+                                             len(conditions)))
+                     if conditions[k] not in self.conditions and
+                     conditions[k].negate() not in self.conditions]
+            if len(block) == 0:
+                continue
+            rows = index.rows([conditions[k] for k in block],
+                              universe, cols)
+            split = ~(np.all(rows == 0, axis=1) | np.all(rows == 1, axis=1))
+            block = [k for k, s in zip(block, split) if s]
+            rows = rows[split]
+            if bound_f is None:
+                bounds = np.zeros(2 * len(block))
+            else:
+                bounds = bound_f(truth, rows, cols)
+            for j, k in enumerate(block):
+                entries.append((bounds[j], 2*k, k))
+                entries.append((bounds[len(block)+j], 2*k+1, k))
+        entries.sort()
+
+        # Construct each refinement only when it is requested
+        for bound, pos, k in entries:
+            p = conditions[k] if pos % 2 == 0 else conditions[k].negate()
+            new = self.__class__(self.action, self.conditions | set([p]),
+                                 self.detype).intern()
+            yield bound, pos, new
     
     @classmethod
     def difference(cls, r1, r2):
@@ -160,9 +272,9 @@ class Rule(object):
             if c in r1.conditions:
                 continue
             # Intersect first rule with negation of each predicate
-            new = cls(r1.action, r1.conditions, r1.detype)
-            new.conditions.add(c.negate())
-            remainder.add(new)
+            new = cls(r1.action, r1.conditions | set([c.negate()]),
+                      r1.detype)
+            remainder.add(new.intern())
         return remainder
 
     @classmethod
@@ -170,12 +282,11 @@ class Rule(object):
         """Returns logical intersection of two rules."""
         if r1.action.name != r2.action.name or r1.detype != r2.detype:
             raise TypeError("Actions and deontic types must match.")
-        new = cls(r1.action, r1.conditions, r1.detype)
         for c in r2.conditions:
             if c.negate() in r1.conditions:
-                return cls(r1.action, [], r1.detype)
-            new.conditions.add(c)
-        return new
+                return cls(r1.action, [], r1.detype).intern()
+        new = cls(r1.action, r1.conditions | r2.conditions, r1.detype)
+        return new.intern()
 
     @classmethod
     def merge(cls, r1, r2):
@@ -185,17 +296,15 @@ class Rule(object):
         sym_diff = r1.conditions ^ r2.conditions
         if len(sym_diff) != 2:
             return None
-        c1, c2 = sym_diff.pop(), sym_diff.pop()
+        c1, c2 = list(sym_diff)
         if c1.name != c2.name:
             # Return None if conditions do not share the same base
             return None
         if c1 != c2.negate():
             # Only merge conditions if they are negations of each other
             return None
-        new = cls(r1.action, r1.conditions, r1.detype)
-        new.conditions.discard(c1)
-        new.conditions.discard(c2)
-        return new
+        new = cls(r1.action, r1.conditions - set([c1, c2]), r1.detype)
+        return new.intern()
     
     def toPrint(self):
         """Converts to human-readable string."""
@@ -225,3 +334,548 @@ class Rule(object):
         conditions = [predicates.Predicate.fromMsg(c) for
                       c in msg.conditions]
         return cls(action, conditions, msg.detype)
+
+class RuleSet(set):
+    """Set of rules compiled into a disjoint sum of products.
+
+    The disjunction of rules is decomposed into mutually exclusive cubes
+    (conjunctions of predicates) the first time it is evaluated after a
+    change, so that evaluation is a flat sum over the cached cubes, e.g.
+    A*B | C -> A*B + !A*C + A*!B*C
+    """
+
+    # Compiled cubes, None if the set has changed since last compilation
+    _cubes = None
+    # Distinct (non-negated) predicates which appear in the cubes
+    _atoms = None
+    # Cubes as lists of (atom index, negated) pairs
+    _terms = None
+    # Cubes as rows of literal indices, for batch evaluation
+    _lit_index = None
+
+    def __init__(self, rules=[]):
+        super(RuleSet, self).__init__(rules)
+        self._changed()
+
+    def _changed(self):
+        """Marks compiled cubes as out of date."""
+        self._cubes = None
+        self._atoms = None
+        self._terms = None
+        self._lit_index = None
+
+    def add(self, rule):
+        super(RuleSet, self).add(rule)
+        self._changed()
+
+    def discard(self, rule):
+        super(RuleSet, self).discard(rule)
+        self._changed()
+
+    def remove(self, rule):
+        super(RuleSet, self).remove(rule)
+        self._changed()
+
+    def pop(self):
+        self._changed()
+        return super(RuleSet, self).pop()
+
+    def clear(self):
+        super(RuleSet, self).clear()
+        self._changed()
+
+    def update(self, *others):
+        super(RuleSet, self).update(*others)
+        self._changed()
+
+    def difference_update(self, *others):
+        super(RuleSet, self).difference_update(*others)
+        self._changed()
+
+    def intersection_update(self, *others):
+        super(RuleSet, self).intersection_update(*others)
+        self._changed()
+
+    def symmetric_difference_update(self, other):
+        super(RuleSet, self).symmetric_difference_update(other)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def cubes(self):
+        """Returns list of disjoint cubes, compiling them if necessary."""
+        if self._cubes is None:
+            rules = [r for r in self if not self._contradicts(r.conditions)]
+            self._cubes = self._decompose(rules, frozenset())
+            # Index the positive form of each predicate
+            index = dict()
+            self._atoms, self._terms = [], []
+            for cube in self._cubes:
+                term = []
+                for p in cube:
+                    atom = p.negate() if p.negated else p
+                    if atom not in index:
+                        index[atom] = len(self._atoms)
+                        self._atoms.append(atom)
+                    term.append((index[atom], p.negated))
+                self._terms.append(term)
+            # Negations are offset by the number of atoms, and rows are
+            # padded with the index of a column of ones
+            n_atoms = len(self._atoms)
+            width = max([1] + [len(t) for t in self._terms])
+            self._lit_index = np.full((len(self._terms), width),
+                                      2*n_atoms, dtype=int)
+            for j, term in enumerate(self._terms):
+                for k, (i, negated) in enumerate(term):
+                    self._lit_index[j, k] = i + n_atoms if negated else i
+        return self._cubes
+
+    def atoms(self):
+        """Returns list of distinct non-negated predicates in the cubes."""
+        self.cubes()
+        return self._atoms
+
+    def evaluate(self, tgt, universe=None):
+        """Evaluates probabilistic disjunction of rules on the target."""
+        # Assume false if no rules
+        if len(self) == 0:
+            return 0.0
+        # Every rule is satisfied if there is no target (c.f. Rule.evaluate)
+        if tgt is None:
+            return 1.0
+        for r in self:
+            if type(tgt) != r.action.tgtype:
+                raise TypeError("Wrong target type.")
+        # Apply each distinct predicate only once
+        self.cubes()
+        truths = [p.apply(tgt, universe=universe) for p in self._atoms]
+        truth = 0.0
+        for term in self._terms:
+            prob = 1.0
+            for i, negated in term:
+                prob *= (1-truths[i]) if negated else truths[i]
+                if prob == 0.0:
+                    break
+            truth += prob
+        return truth
+
+    def evaluateBatch(self, tgts, universe=None):
+        """Evaluates rule set on a list of targets using array operations.
+
+        Builds a (targets x predicates) truth matrix, then computes all
+        cube products and their sum at once. Returns an array of truths.
+        """
+        tgts = list(tgts)
+        if len(self) == 0:
+            return np.zeros(len(tgts))
+        # Every rule is satisfied if there is no target (c.f. Rule.evaluate)
+        truth = np.ones(len(tgts))
+        mask = np.array([t is not None for t in tgts], dtype=bool)
+        objs = [t for t in tgts if t is not None]
+        if len(objs) == 0:
+            return truth
+        tgtypes = set(r.action.tgtype for r in self)
+        if len(tgtypes) > 1 or any(type(o) not in tgtypes for o in objs):
+            raise TypeError("Wrong target type.")
+        self.cubes()
+        T = predicates.truthMatrix(self._atoms, objs, universe)
+        truth[mask] = self.evaluateTruths(T)
+        return truth
+
+    def evaluateTruths(self, truths):
+        """Evaluates rule set from truth values of its atoms (c.f. atoms).
+
+        The last axis of the truths array should index the atoms, and the
+        rule set is evaluated over all other axes at once.
+        """
+        self.cubes()
+        truths = np.asarray(truths, dtype=float)
+        # Columns are the predicates, their negations, then a column of ones
+        L = np.concatenate([truths, 1-truths,
+                            np.ones(truths.shape[:-1] + (1,))], axis=-1)
+        return L[..., self._lit_index].prod(axis=-1).sum(axis=-1)
+
+    def minimize(self):
+        """Returns an equivalent rule set with fewer or shorter rules.
+
+        Rules are treated as cubes over independent atoms, as when they
+        are evaluated, and minimized with espresso-style heuristics: each
+        rule (largest first) is expanded by dropping conditions while it
+        stays within the disjunction of the original rules, then rules
+        which are covered by the remaining ones are removed.
+        """
+        groups = dict()
+        for r in self:
+            if self._contradicts(r.conditions):
+                continue
+            key = (r.action.name, r.detype)
+            groups.setdefault(key, (r.action, []))[1].append(r.conditions)
+        minimized = RuleSet()
+        for (act_name, detype), (action, cover) in groups.iteritems():
+            cubes = []
+            cover.sort(key=lambda c : (-len(c), self._sortKey(c)))
+            for c in cover:
+                # Skip cubes within ones that were already expanded
+                if any(e <= c for e in cubes):
+                    continue
+                for p in sorted(c, key=lambda p : self._sortKey([p])):
+                    if self._contains(cover, c - set([p])):
+                        c = c - set([p])
+                cubes = [e for e in cubes if not c <= e] + [c]
+            # Remove redundant cubes, trying the largest first
+            for c in sorted(cubes, key=lambda c : (-len(c),
+                                                   self._sortKey(c))):
+                rest = [e for e in cubes if e is not c]
+                if len(rest) > 0 and self._contains(rest, c):
+                    cubes = rest
+            minimized.update(Rule(action, c, detype).intern()
+                             for c in cubes)
+        return minimized
+
+    @staticmethod
+    def _sortKey(conditions):
+        """Returns canonical sort key of a set of conditions."""
+        return sorted(p._key() for p in conditions)
+
+    @classmethod
+    def _contains(cls, cover, cube):
+        """Checks if cube implies the disjunction of cubes in cover."""
+        # Cube is covered iff the cofactor of cover on it is a tautology
+        cofactor = [c - cube for c in cover
+                    if not any(p.negate() in cube for p in c)]
+        return cls._tautology(cofactor)
+
+    @classmethod
+    def _tautology(cls, cubes):
+        """Checks if disjunction of cubes is always true."""
+        if any(len(c) == 0 for c in cubes):
+            return True
+        if len(cubes) == 0:
+            return False
+        # Split on the atom which appears in the most cubes
+        counts = dict()
+        for c in cubes:
+            for p in c:
+                atom = p.negate() if p.negated else p
+                counts[atom] = counts.get(atom, 0) + 1
+        atom = max(counts.iterkeys(), key=lambda a : (counts[a], a._key()))
+        for lit in [atom, atom.negate()]:
+            if not cls._tautology([c - set([lit]) for c in cubes
+                                   if lit.negate() not in c]):
+                return False
+        return True
+
+    @staticmethod
+    def _contradicts(conditions):
+        """Checks if conditions contain complementary predicates."""
+        return any(p.negate() in conditions for p in conditions)
+
+    @classmethod
+    def _decompose(cls, rules, context):
+        """Recursively decomposes rules into disjoint cubes under context.
+
+        Mirrors Rule.evaluateOr, but stores the parts instead of their
+        probabilities: the first rule is one cube, and the remaining rules
+        are decomposed under each disjoint part of its complement.
+        """
+        if len(rules) == 0:
+            return []
+        cur, rest = rules[0], rules[1:]
+        cubes = [context | cur.conditions]
+        # Conditions already in the context need not be complemented
+        conditions = [p for p in cur.conditions if p not in context]
+        prefix = set(context)
+        for p in conditions:
+            # e.g. !(A*B*C) -> (!A + A*!B + A*B*!C)
+            part = frozenset(prefix | set([p.negate()]))
+            # Remove rules with complementary predicates
+            remainder = [r for r in rest if
+                         not any(c.negate() in part for c in r.conditions)]
+            cubes += cls._decompose(remainder, part)
+            prefix.add(p)
+        return cubes
+
+class CoverageIndex(object):
+    """Truth values of rule conditions over a set of permission targets.
+
+    Each grounded condition is evaluated once on all targets and stored
+    as a row, so the truth of a rule on all targets is the product of its
+    condition rows, and the targets it covers form a boolean mask. Columns
+    are added for new permissions and marked stale when the version of
+    their target changes, and all stale columns are (re)computed at once
+    the next time rows are read. Rows which depend on the universe (i.e.
+    on Any, bound objects or areas) are dropped when it differs between
+    the snapshots that rows are read with. The version of the index is
+    incremented whenever a permission value, target or universe changes.
+    """
+
+    def __init__(self, cover_thresh=0.5, version=0):
+        self.cover_thresh = cover_thresh
+        self.version = version # Incremented on every change
+        self.tgts = [] # Permission targets, one per column
+        self.cols = dict() # Column of each target
+        self._versions = [] # Target versions that columns were computed for
+        self._vals = np.zeros(1) # Permission values, padded to capacity
+        self._rows = dict() # Truth rows of non-negated conditions
+        self._stale = set() # Columns which have yet to be computed
+        self._universe = None # Universe snapshot last read with
+        self._ukeys = dict() # Keys of the universes of each argtype
+
+    def __len__(self):
+        return len(self.tgts)
+
+    def clear(self):
+        """Removes all targets and condition rows."""
+        self.__init__(self.cover_thresh, self.version + 1)
+
+    def values(self):
+        """Returns array of permission values."""
+        return self._vals[:len(self.tgts)]
+
+    def positives(self):
+        """Returns mask of targets with positive permissions."""
+        return self.values() >= self.cover_thresh
+
+    def setPerm(self, tgt, val):
+        """Adds or updates permission value for target."""
+        self.update({tgt: val})
+
+    def update(self, perms):
+        """Adds or updates permission values from target-value dict."""
+        for tgt, val in perms.iteritems():
+            version = getattr(tgt, "version", None)
+            if tgt in self.cols:
+                j = self.cols[tgt]
+                self.tgts[j] = tgt
+                if self._vals[j] != val:
+                    self._vals[j] = val
+                    self.version += 1
+                # Recompute column if target has changed since
+                if self._versions[j] != version:
+                    self._versions[j] = version
+                    self._stale.add(j)
+                    self.version += 1
+                continue
+            self.version += 1
+            j = len(self.tgts)
+            # Double capacity if necessary
+            if j == len(self._vals):
+                self._vals = self._grow(self._vals)
+                for p in self._rows.keys():
+                    self._rows[p] = self._grow(self._rows[p])
+            self.tgts.append(tgt)
+            self.cols[tgt] = j
+            self._versions.append(version)
+            self._vals[j] = val
+            self._stale.add(j)
+
+    def sync(self, universe=None):
+        """Drops rows which depend on parts of the universe that changed.
+
+        Rows read without a snapshot are assumed to be up to date.
+        """
+        if universe is None or universe is self._universe:
+            return
+        self._universe = universe
+        changed = set()
+        for argtype in self._ukeys.keys():
+            key = universe.key(argtype)
+            if key != self._ukeys[argtype]:
+                self._ukeys[argtype] = key
+                changed.add(argtype)
+        if len(changed) == 0:
+            return
+        for p in self._rows.keys():
+            if not changed.isdisjoint(self._depends(p)):
+                del self._rows[p]
+        self.version += 1
+
+    def truth(self, rule, universe=None, cols=None):
+        """Returns truth of rule on all (or the given) target columns."""
+        self.sync(universe)
+        self._compute(universe)
+        cols = slice(0, len(self.tgts)) if cols is None else cols
+        truth = np.ones(len(self.tgts))[cols]
+        # Multiply in canonical order so results do not depend on hashing
+        for p in sorted(rule.conditions, key=self.order):
+            row = self._row(p.negate() if p.negated else p, universe)[cols]
+            truth = truth * ((1-row) if p.negated else row)
+        return truth
+
+    def rows(self, atoms, universe=None, cols=None):
+        """Returns (atoms x targets) array of truth values.
+
+        If cols is given, only those target columns are returned.
+        """
+        self.sync(universe)
+        self._compute(universe)
+        n_tgts = len(self.tgts)
+        if cols is None:
+            rows = [self._row(p, universe)[:n_tgts] for p in atoms]
+        else:
+            rows = [self._row(p, universe)[cols] for p in atoms]
+            n_tgts = len(cols)
+        return np.array(rows).reshape(len(rows), n_tgts)
+
+    @staticmethod
+    def order(p):
+        """Canonical sort key of a condition, regardless of negation."""
+        key = p._key()
+        return (key[0], key[2])
+
+    def covers(self, rule, universe=None):
+        """Returns mask of targets covered by rule."""
+        return self.truth(rule, universe) >= self.cover_thresh
+
+    @staticmethod
+    def _depends(p):
+        """Returns argtypes whose universes the truth of p depends on."""
+        return set(t for b, t in zip(p.bindings, p.argtypes)
+                   if b == objects.Any or
+                   (t in [objects.Object, objects.Area] and
+                    b != objects.Nil))
+
+    def _row(self, p, universe=None):
+        """Returns truth row of condition, evaluating it if necessary."""
+        if p not in self._rows:
+            # Track the universes that the new row depends on
+            if universe is not None:
+                for argtype in self._depends(p):
+                    if argtype not in self._ukeys:
+                        self._ukeys[argtype] = universe.key(argtype)
+            row = np.zeros(len(self._vals))
+            if len(self.tgts) > 0:
+                row[:len(self.tgts)] = p.applyBatch(self.tgts, universe)
+            self._rows[p] = row
+        return self._rows[p]
+
+    def _compute(self, universe=None):
+        """Evaluates all condition rows on the stale columns."""
+        if len(self._stale) == 0:
+            return
+        cols = sorted(self._stale)
+        tgts = [self.tgts[j] for j in cols]
+        for p, row in self._rows.iteritems():
+            row[cols] = p.applyBatch(tgts, universe)
+        self._stale.clear()
+
+    @staticmethod
+    def _grow(arr):
+        """Returns copy of array with doubled length."""
+        new = np.zeros(2 * len(arr))
+        new[:len(arr)] = arr
+        return new
+
+class RuleCache(object):
+    """Client-side cache of the active rule set for each action.
+
+    Rule sets are looked up from the rule manager the first time they are
+    requested, then kept current by applying the changes it publishes, so
+    that get() does not make service calls. A rule set is looked up again
+    if a change was missed. Cached rule sets are replaced rather than
+    modified, and should not be modified by callers.
+    """
+
+    def __init__(self):
+        self.rule_db = dict() # Rule set for each action name
+        self.versions = dict() # Version of each rule set
+        self.t_changed = dict() # When each version was received
+        self.lock = threading.Lock()
+        # Statistics
+        self.hits = 0
+        self.lookups = 0
+        self.updates = 0
+        self.resyncs = 0
+        self._lookupRules = rospy.ServiceProxy("lookup_rules", LookupRules)
+        self._update_sub = rospy.Subscriber("rule_updates", RuleUpdateMsg,
+                                            self._updateCb)
+        self._stats_srv = rospy.Service("~rule_cache_stats", Trigger,
+                                        self._statsCb)
+
+    def get(self, act_name):
+        """Returns cached rule set, looking it up if not yet cached."""
+        rule_set = self.rule_db.get(act_name)
+        if rule_set is not None:
+            self.hits += 1
+            return rule_set
+        self.lock.acquire()
+        try:
+            return self.lookup(act_name)
+        finally:
+            self.lock.release()
+
+    def lookup(self, act_name):
+        """Looks up rule set unless cached version is current."""
+        self.lookups += 1
+        resp = self._lookupRules(action=act_name,
+                                 version=self.versions.get(act_name, 0))
+        if not resp.unchanged:
+            self.rule_db[act_name] = \
+                RuleSet([Rule.fromMsg(m) for m in resp.rule_set])
+            self.versions[act_name] = resp.version
+            self.t_changed[act_name] = rospy.get_time()
+        return self.rule_db[act_name]
+
+    def age(self, act_name):
+        """Returns seconds since the cached rule set last changed.
+
+        Rule sets which are not changed are not republished, so the time
+        they were last confirmed would grow even though they are current.
+        """
+        if act_name not in self.t_changed:
+            return float('inf')
+        return rospy.get_time() - self.t_changed[act_name]
+
+    def stats(self):
+        """Returns string summary of cache freshness and usage."""
+        ages = [self.age(a) for a in self.t_changed]
+        max_age = max(ages) if len(ages) > 0 else 0.0
+        return ("actions={} hits={} lookups={} updates={} resyncs={} " +
+                "max_age={:.3f}").\
+            format(len(self.rule_db), self.hits, self.lookups,
+                   self.updates, self.resyncs, max_age)
+
+    def _updateCb(self, msg):
+        """Applies published changes to cached rule set."""
+        self.lock.acquire()
+        try:
+            version = self.versions.get(msg.action)
+            if version is None or msg.version == version:
+                # Ignore rule sets that are not cached or already current
+                return
+            if msg.version != version + 1:
+                # Look up rule set again if changes were missed
+                self.resyncs += 1
+                self.lookup(msg.action)
+                return
+            rule_set = RuleSet(self.rule_db[msg.action])
+            for m in msg.removed:
+                rule_set.discard(Rule.fromMsg(m))
+            for m in msg.added:
+                rule_set.add(Rule.fromMsg(m))
+            self.rule_db[msg.action] = rule_set
+            self.versions[msg.action] = msg.version
+            self.t_changed[msg.action] = rospy.get_time()
+            self.updates += 1
+        except rospy.ServiceException:
+            rospy.logwarn("Could not look up rules for %s", msg.action)
+        finally:
+            self.lock.release()
+
+    def _statsCb(self, req):
+        """Reports cache freshness and usage."""
+        return TriggerResponse(True, self.stats())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Checks parts of the rule manager which do not need a running node."""
+import os
+import sys
+import random
+import unittest
+import numpy as np
+from ownage_bot import *
+from ownage_bot.objects import Category
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "nodes"))
+from rule_manager import RuleTally, RuleScore
+
+class TestRuleTally(unittest.TestCase):
+    """Checks the running tally of rule set performance."""
+
+    def setUp(self):
+        block = Category("block")
+        self.is_block = predicates.InCategory.bind([objects.Nil, block])
+        self.objs = [Object(id=i) for i in range(4)]
+        for obj in self.objs[:2]:
+            obj.categories[block] = 1.0
+
+    def testNilPerms(self):
+        """Perms without targets are not tallied, even if rules apply."""
+        tally = RuleTally()
+        tally.update({objects.Nil: 1.0})
+        rule_set = RuleSet([Rule(actions.Replace)])
+        metrics = tally.metrics(rule_set)
+        self.assertEqual(len(tally), 0)
+        self.assertEqual(metrics.tp + metrics.fn, 0.0)
+
+    def testUpdate(self):
+        """Tally should match metrics computed from scratch."""
+        tally = RuleTally()
+        perms = dict((o, float(o.id % 2)) for o in self.objs)
+        tally.update(perms)
+        rule_set = RuleSet([Rule(actions.Trash, [self.is_block])])
+        metrics = tally.metrics(rule_set)
+        # Objects 0 and 1 are blocks, objects 1 and 3 are forbidden
+        self.assertEqual((metrics.tp, metrics.tn, metrics.fp, metrics.fn),
+                         (1.0, 1.0, 1.0, 1.0))
+        # Overwriting a permission updates the tally
+        tally.update({self.objs[0]: 1.0})
+        metrics = tally.metrics(rule_set)
+        self.assertEqual((metrics.tp, metrics.tn, metrics.fp, metrics.fn),
+                         (2.0, 1.0, 0.0, 1.0))
+        # Removing the rule updates the predictions it covered
+        metrics = tally.metrics(RuleSet())
+        self.assertEqual((metrics.tp, metrics.tn, metrics.fp, metrics.fn),
+                         (0.0, 1.0, 0.0, 3.0))
+
+class TestRuleScore(unittest.TestCase):
+    """Checks rule scores and their bounds."""
+
+    def testBounds(self):
+        """Bounds of refinements should not exceed their scores."""
+        random.seed(0)
+        cats = [Category(c) for c in "abcd"]
+        objs = [Object(id=i) for i in range(30)]
+        for obj in objs:
+            obj.categories = dict((c, random.choice([0.0, 1.0, 0.6]))
+                                  for c in cats)
+        index = CoverageIndex()
+        index.update(dict((o, random.choice([0.0, 1.0, 0.3]))
+                          for o in objs))
+        universe = Universe({Object: objs, Agent: [], Area: [],
+                             Category: cats, Color: []})
+        rule = Rule(actions.Trash)
+        for kind in [RuleScore.covered, RuleScore.excess, RuleScore.overlap]:
+            for mask in [index.positives(), ~index.positives()]:
+                score_f = RuleScore(kind, index, mask, universe)
+                refined = list(rule.refineRelevant(index, score_f.bounds,
+                                                   universe))
+                self.assertGreater(len(refined), 0)
+                for bound, pos, r in refined:
+                    self.assertLessEqual(bound, score_f(r))
+
+if __name__ == '__main__':
+    unittest.main()
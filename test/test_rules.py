@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""Checks compiled rule set evaluation against rule-by-rule semantics."""
+import random
+import itertools
+import unittest
+import numpy as np
+from geometry_msgs.msg import Point
+from ownage_bot import *
+from ownage_bot.objects import Category
+
+class TestRuleSet(unittest.TestCase):
+    """Compares RuleSet methods with brute force over atom assignments."""
+
+    n_trials = 200
+
+    def setUp(self):
+        random.seed(0)
+        self.cats = [Category(c) for c in "abcde"]
+        self.atoms = [predicates.InCategory.bind([objects.Nil, c])
+                      for c in self.cats]
+
+    def randRule(self, max_conds=3, atoms=None):
+        """Returns rule with random (possibly complementary) conditions."""
+        atoms = self.atoms if atoms is None else atoms
+        conds = [random.choice(atoms)
+                 for i in range(random.randint(0, max_conds))]
+        conds = [c.negate() if random.random() < 0.5 else c for c in conds]
+        return Rule(actions.Trash, conds).intern()
+
+    def randRuleSet(self, max_rules=5):
+        """Returns rule set with a random number of rules."""
+        return RuleSet(self.randRule()
+                       for i in range(random.randint(0, max_rules)))
+
+    def randObject(self, id):
+        """Returns object with certain and uncertain categories."""
+        obj = Object(id=id)
+        obj.categories = dict((c, random.choice([0.0, 1.0, random.random()]))
+                              for c in self.cats)
+        return obj
+
+    def satisfies(self, rules, assign):
+        """Checks if any rule holds under a truth assignment of atoms."""
+        lit = lambda p : assign[p.negate()] != 1 if p.negated else assign[p]
+        return any(all(lit(p) for p in r.conditions) for r in rules)
+
+    def assignments(self):
+        """Iterates over all truth assignments of the atoms."""
+        for vals in itertools.product([0, 1], repeat=len(self.atoms)):
+            yield dict(zip(self.atoms, vals))
+
+    def bruteForce(self, rules, obj):
+        """Probability that any rule holds, with independent atoms."""
+        probs = [p.apply(obj) for p in self.atoms]
+        truth = 0.0
+        for assign in self.assignments():
+            weight = 1.0
+            for p, prob in zip(self.atoms, probs):
+                weight *= prob if assign[p] else (1-prob)
+            if self.satisfies(rules, assign):
+                truth += weight
+        return truth
+
+    def testEvaluate(self):
+        """Compiled evaluation should match rule-by-rule evaluation."""
+        for i in range(self.n_trials):
+            rule_set = self.randRuleSet()
+            obj = self.randObject(i)
+            expected = self.bruteForce(rule_set, obj)
+            self.assertAlmostEqual(rule_set.evaluate(obj), expected)
+            # Recursive evaluation does not detect contradictory rules
+            if not any(RuleSet._contradicts(r.conditions) for r in rule_set):
+                self.assertAlmostEqual(Rule.evaluateOr(rule_set, obj),
+                                       expected)
+
+    def testEvaluateBatch(self):
+        """Batch evaluation should match evaluation on each target."""
+        for i in range(self.n_trials // 10):
+            rule_set = self.randRuleSet()
+            objs = [self.randObject(j) for j in range(20)]
+            expected = [self.bruteForce(rule_set, o) for o in objs]
+            np.testing.assert_allclose(rule_set.evaluateBatch(objs),
+                                       expected, atol=1e-9)
+        # Empty rule sets are false for every target
+        np.testing.assert_allclose(RuleSet().evaluateBatch(objs), 0.0)
+
+    def testMinimize(self):
+        """Minimized rule sets should be equivalent and no larger."""
+        for i in range(self.n_trials):
+            rule_set = self.randRuleSet(8)
+            minimized = rule_set.minimize()
+            self.assertLessEqual(len(minimized), len(rule_set))
+            for assign in self.assignments():
+                self.assertEqual(self.satisfies(minimized, assign),
+                                 self.satisfies(rule_set, assign))
+            objs = [self.randObject(j) for j in range(5)]
+            np.testing.assert_allclose(minimized.evaluateBatch(objs),
+                                       rule_set.evaluateBatch(objs),
+                                       atol=1e-9)
+
+    def testTautology(self):
+        """Tautology check should match checking every assignment."""
+        for i in range(self.n_trials):
+            # Use few atoms so that tautologies are common
+            rules = [self.randRule(2, self.atoms[:3])
+                     for j in range(random.randint(0, 4))]
+            rules = [r for r in rules
+                     if not RuleSet._contradicts(r.conditions)]
+            cubes = [r.conditions for r in rules]
+            expected = all(self.satisfies(rules, a)
+                           for a in self.assignments())
+            self.assertEqual(RuleSet._tautology(cubes), expected)
+        # Complementary literals cover everything
+        p = self.atoms[0]
+        self.assertTrue(RuleSet._tautology([frozenset([p]),
+                                            frozenset([p.negate()])]))
+        self.assertFalse(RuleSet._tautology([]))
+        self.assertTrue(RuleSet._tautology([frozenset()]))
+
+class TestCoverageIndex(unittest.TestCase):
+    """Checks that coverage index rows follow the universe."""
+
+    def testUniverseChange(self):
+        """Rows over Any should be recomputed when the universe changes."""
+        Object.use_inferred = False
+        agents = [Agent(id=1), Agent(id=2)]
+        objs = [Object(id=i) for i in range(3)]
+        for obj, agent in zip(objs, agents):
+            obj.ownership[agent.id] = 1.0
+        index = CoverageIndex()
+        index.update(dict((o, 1.0) for o in objs))
+        cols = [index.cols[o] for o in objs]
+        owned = Rule(actions.Trash,
+                     [predicates.OwnedBy.bind([objects.Nil, objects.Any])])
+        truth = index.truth(owned, Universe({Agent: agents[:1]}))
+        np.testing.assert_allclose(truth[cols], [1.0, 0.0, 0.0])
+        # Equal snapshots share rows and the index version
+        version = index.version
+        truth = index.truth(owned, Universe({Agent: agents[:1]}))
+        np.testing.assert_allclose(truth[cols], [1.0, 0.0, 0.0])
+        self.assertEqual(index.version, version)
+        # New agents change the rows and the index version
+        truth = index.truth(owned, Universe({Agent: agents}))
+        np.testing.assert_allclose(truth[cols], [1.0, 1.0, 0.0])
+        self.assertGreater(index.version, version)
+
+    def testAreaRedefined(self):
+        """Conditions on named areas should follow their definitions."""
+        objs = [Object(id=i) for i in range(2)]
+        objs[1].position = Point(x=2.0, y=2.0, z=0.0)
+        old = Area([(-1, -1), (1, -1), (1, 1), (-1, 1)], name="test")
+        new = Area([(1, 1), (3, 1), (3, 3), (1, 3)], name="test")
+        Area._define([old])
+        in_old = predicates.InArea.bind([objects.Nil, old])
+        index = CoverageIndex()
+        index.update(dict((o, 1.0) for o in objs))
+        cols = [index.cols[o] for o in objs]
+        rule = Rule(actions.Trash, [in_old])
+        truth = index.truth(rule, Universe({Area: [old]}))
+        np.testing.assert_allclose(truth[cols], [1.0, 0.0])
+        self.assertEqual(in_old.apply(objs[0]), 1.0)
+        # Redefined areas are still bound to the same predicate
+        Area._define([new])
+        self.assertIs(predicates.InArea.bind([objects.Nil, new]), in_old)
+        self.assertEqual(in_old.apply(objs[0]), 0.0)
+        truth = index.truth(rule, Universe({Area: [new]}))
+        np.testing.assert_allclose(truth[cols], [0.0, 1.0])
+
+if __name__ == '__main__':
+    unittest.main()